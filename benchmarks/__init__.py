@@ -0,0 +1,93 @@
+"""
+Benchmarks for djinn's persistence and API layers. Run them from the repository root, e.g.
+`python -m benchmarks.schema --rows 100000`. They use throwaway SQLite databases and print a table of timings.
+"""
+from __future__ import print_function
+
+import random
+import time
+
+STAGES = ['Checkout', 'Setup', 'Build', 'Unit Tests', 'Integration Tests', 'Deploy', 'Smoke Tests']
+ERRORS = ['hudson.AbortException', 'java.lang.InterruptedException', 'hudson.remoting.ChannelClosedException']
+
+
+def generate_results(count, projects=20, repos_per_project=25, failure_ratio=0.3, max_message_repeats=500, seed=0):
+    """
+    Generate results in the format produced by djinn.djenkins.DJenkins.
+    :param count: number of results to generate
+    :param projects: number of projects to spread them over
+    :param repos_per_project: number of repositories in each project
+    :param failure_ratio: fraction of runs which fail, between 0 and 1
+    :param max_message_repeats: upper bound on how many times a failure's error message repeats, to vary its size
+    :param seed: random seed, so runs are repeatable
+    :return: generator of result dicts
+    """
+    rand = random.Random(seed)
+    repos = [('PROJ{}'.format(p), 'proj{}-repo{}-service'.format(p, r)) for p in range(projects)
+             for r in range(repos_per_project)]
+    start = 1491143071036
+    for i in range(count):
+        project, repo = repos[i % len(repos)]
+        run_id = i // len(repos) + 1
+        result = {'id': '{}{}'.format(repo, run_id), 'run_id': str(run_id), 'project': project, 'repository': repo,
+                  'timestamp': start + i * 60000, 'status': 'SUCCESS', 'success': True}
+        if rand.random() < failure_ratio:
+            result.update({'status': 'FAILED', 'success': False, 'stage_failed': rand.choice(STAGES),
+                           'error_type': rand.choice(ERRORS),
+                           'error_message': 'Oops. ' * rand.randint(1, max_message_repeats)})
+        yield result
+
+
+def populate(db, results, chunk_size=10000):
+    """
+    Write generated results straight into pipeline_runs with executemany, far faster than the ingest path,
+    then rebuild the tables derived from it.
+    :param db: PipelineResults instance
+    :param results: iterable of result dicts, e.g. from generate_results
+    :param chunk_size: number of rows per executemany
+    """
+    from djinn.database.entity import PipelineRun
+    from djinn.djinnutils import chunked
+
+    columns = [column.name for column in PipelineRun.__table__.columns]
+    session = db.write_session_factory()
+    for chunk in chunked(list(results), chunk_size):
+        rows = [dict((column, result.get(column)) for column in columns) for result in chunk]
+        for row in rows:
+            row['run_id'] = int(row['run_id'])
+        session.execute(PipelineRun.__table__.insert(), rows)
+    session.commit()
+    session.close()
+    db.rebuild_latest_runs()
+    db.rebuild_failure_counts()
+
+
+def timed(func, repeat=3):
+    """
+    Time a function, keeping the best of several runs to reduce noise.
+    :param func: function taking no arguments
+    :param repeat: number of times to run it
+    :return: tuple of (best time in seconds, return value of the last run)
+    """
+    best = None
+    value = None
+    for _ in range(repeat):
+        start = time.time()
+        value = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, value
+
+
+def print_table(headers, rows):
+    """
+    Print rows as a plain text table.
+    :param headers: list of column headings
+    :param rows: list of lists of values
+    """
+    rows = [[str(value) for value in row] for row in rows]
+    widths = [max(len(str(header)), *[len(row[i]) for row in rows]) if rows else len(str(header))
+              for i, header in enumerate(headers)]
+    print('  '.join(str(header).ljust(width) for header, width in zip(headers, widths)))
+    for row in rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)))
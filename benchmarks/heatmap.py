@@ -0,0 +1,57 @@
+"""
+Compare building heatmaps by loading every failed run as an ORM object and grouping in Python, or counting with
+the NumPy strategies, against summing the failure counts rollup in the database.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from benchmarks import generate_results, populate, timed, print_table
+from djinn import PipelineResults
+from djinn.analysis import gen_heatmap_with_strategy, gen_heatmap_from_counts, projects_stage_inner_groupby, \
+    repos_stage_inner_groupby
+from djinn.analysis.vectorized import vectorized_projects_strategy, vectorized_repos_strategy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000, help='number of pipeline runs to generate')
+    args = parser.parse_args()
+    tempdir = tempfile.mkdtemp()
+    try:
+        db = PipelineResults('sqlite:///{}'.format(os.path.join(tempdir, 'benchmark.db')))
+        populate(db, generate_results(args.rows, max_message_repeats=20))
+        project = 'PROJ0'
+        all_failures = db.get_all_failures
+        project_failures = lambda: db.get_failed_results_for_project(project)
+        cases = [
+            ('/heatmap/',
+             lambda: gen_heatmap_with_strategy(projects_stage_inner_groupby, all_failures()),
+             lambda: gen_heatmap_with_strategy(vectorized_projects_strategy, all_failures()),
+             lambda: gen_heatmap_from_counts(db.get_failure_counts(group_by='project'))),
+            ('/heatmap/{}'.format(project),
+             lambda: gen_heatmap_with_strategy(repos_stage_inner_groupby, project_failures()),
+             lambda: gen_heatmap_with_strategy(vectorized_repos_strategy, project_failures()),
+             lambda: gen_heatmap_from_counts(db.get_failure_counts(group_by='repository', project=project))),
+        ]
+        rows = list()
+        for route, python_path, numpy_path, sql_path in cases:
+            python_time, python_heatmap = timed(python_path)
+            numpy_time, numpy_heatmap = timed(numpy_path)
+            sql_time, sql_heatmap = timed(sql_path)
+            identical = all(python_heatmap['x'] == heatmap['x'] and python_heatmap['z'] == heatmap['z'] and
+                            list(python_heatmap['y']) == list(heatmap['y']) for heatmap in (numpy_heatmap, sql_heatmap))
+            rows.append([route, '{:.3f}'.format(python_time), '{:.3f}'.format(numpy_time), '{:.3f}'.format(sql_time),
+                         identical])
+        print('{} rows'.format(args.rows))
+        print_table(['route', 'ORM + Python (s)', 'ORM + NumPy (s)', 'failure_counts rollup (s)', 'identical output'],
+                    rows)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
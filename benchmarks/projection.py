@@ -0,0 +1,58 @@
+"""
+Compare the payload size and latency of /results/ with every column against requests restricted with fields=,
+on a failure-heavy dataset where most runs carry a long error message.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from falcon import testing
+
+from benchmarks import generate_results, populate, timed, print_table
+from djinn import PipelineResults
+from djinn.api import DJinnAPI
+
+CASES = [('all columns', ''), ('status,timestamp', 'fields=status,timestamp'),
+         ('status,success,stage_failed,timestamp', 'fields=status,success,stage_failed,timestamp')]
+
+
+def get_body(app, query_string):
+    """
+    Serve a single /results/ request.
+    :param app: WSGI app
+    :param query_string: query string for the request
+    :return: response body as string
+    """
+    return ''.join(app(testing.create_environ(path='/results/', query_string=query_string), lambda *args: None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=50000, help='number of pipeline runs to generate')
+    args = parser.parse_args()
+    tempdir = tempfile.mkdtemp()
+    try:
+        db = PipelineResults('sqlite:///{}'.format(os.path.join(tempdir, 'benchmark.db')))
+        populate(db, generate_results(args.rows, failure_ratio=0.8, max_message_repeats=600))
+        # Disable the response cache so every request reads from the database.
+        app = DJinnAPI(djenkins=None, pipeline_results=db, cache_size=0)
+        baseline_time = baseline_size = None
+        rows = list()
+        for name, query_string in CASES:
+            elapsed, body = timed(lambda: get_body(app, query_string))
+            if baseline_time is None:
+                baseline_time, baseline_size = elapsed, len(body)
+            rows.append([name, '{:.3f}'.format(elapsed), '{:.1f}'.format(len(body) / 1048576.0),
+                         '{:.1f}x'.format(baseline_time / max(elapsed, 1e-6)),
+                         '{:.1f}x'.format(baseline_size / float(max(len(body), 1)))])
+        print('{} rows'.format(args.rows))
+        print_table(['fields', 'latency (s)', 'payload (MB)', 'faster', 'smaller'], rows)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Measure the cost of building tracked ORM instances for large reads, by comparing the ORM getters against their
+Core equivalents returning plain rows, both for fetching and for formatting the results as the API does.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from benchmarks import generate_results, populate, timed, print_table
+from djinn import PipelineResults
+from djinn.api.resources import format_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200000, help='number of pipeline runs to generate')
+    args = parser.parse_args()
+    tempdir = tempfile.mkdtemp()
+    try:
+        db = PipelineResults('sqlite:///{}'.format(os.path.join(tempdir, 'benchmark.db')))
+        populate(db, generate_results(args.rows, max_message_repeats=5))
+        project = 'PROJ0'
+        cases = [
+            ('all results', db.get_all_results, db.get_result_rows),
+            ('results for {}'.format(project), lambda: db.get_results_for_project(project),
+             lambda: db.get_result_rows(project=project)),
+            ('latest results', db.get_latest_results, db.get_latest_result_rows),
+        ]
+        rows = list()
+        for name, orm_getter, core_getter in cases:
+            orm_time, results = timed(orm_getter)
+            core_time, _ = timed(core_getter)
+            orm_total, _ = timed(lambda: format_results(orm_getter()))
+            core_total, _ = timed(lambda: format_results(core_getter()))
+            overhead = (orm_total - core_total) / max(len(results), 1) * 1e6
+            rows.append([name, len(results), '{:.3f}'.format(orm_time), '{:.3f}'.format(core_time),
+                         '{:.3f}'.format(orm_total), '{:.3f}'.format(core_total),
+                         '{:.1f}x'.format(orm_total / max(core_total, 1e-6)), '{:.1f}'.format(overhead)])
+        print('{} rows'.format(args.rows))
+        print_table(['read', 'results', 'ORM fetch (s)', 'Core fetch (s)', 'ORM + format (s)', 'Core + format (s)',
+                     'speedup', 'ORM overhead per row (us)'], rows)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Time each PipelineResults getter's query against the legacy string-typed, unindexed pipeline_runs table, then
+migrate the same database and time the queries the getters now run.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+
+from sqlalchemy import create_engine, text
+
+from benchmarks import generate_results, timed, print_table
+from djinn import PipelineResults
+
+LEGACY_SCHEMA = """
+CREATE TABLE pipeline_runs (
+    id VARCHAR(255) NOT NULL, run_id VARCHAR(255), project VARCHAR(255), repository VARCHAR(255),
+    status VARCHAR(255), timestamp VARCHAR(255), success BOOLEAN, stage_failed VARCHAR(255),
+    error_type VARCHAR(255), error_message VARCHAR(4096), PRIMARY KEY (id)
+)
+"""
+COLUMNS = ['id', 'run_id', 'project', 'repository', 'status', 'timestamp', 'success', 'stage_failed', 'error_type',
+           'error_message']
+LEGACY_LATEST = """
+SELECT p.* FROM pipeline_runs p, (SELECT repository, max(CAST(run_id AS INTEGER)) AS max_run_id
+FROM pipeline_runs {where} GROUP BY repository) AS subq
+WHERE p.repository = subq.repository AND p.run_id = CAST(subq.max_run_id AS VARCHAR)
+"""
+LATEST = 'SELECT p.* FROM pipeline_runs p JOIN latest_runs l ON l.result_id = p.id {where}'
+
+# (getter, legacy query, migrated query). Legacy queries compare strings and cast run IDs, as the getters used to.
+QUERIES = [
+    ('get_all_results', 'SELECT * FROM pipeline_runs WHERE timestamp <= :timestamp',
+     'SELECT * FROM pipeline_runs WHERE timestamp <= :timestamp'),
+    ('get_all_failures', 'SELECT * FROM pipeline_runs WHERE success = 0',
+     'SELECT * FROM pipeline_runs WHERE success = 0'),
+    ('get_results_for_project', 'SELECT * FROM pipeline_runs WHERE project = :project AND timestamp <= :timestamp',
+     'SELECT * FROM pipeline_runs WHERE project = :project AND timestamp <= :timestamp'),
+    ('get_results_for_repo', 'SELECT * FROM pipeline_runs WHERE repository = :repo AND timestamp <= :timestamp',
+     'SELECT * FROM pipeline_runs WHERE repository = :repo AND timestamp <= :timestamp'),
+    ('get_failed_results_for_project', 'SELECT * FROM pipeline_runs WHERE project = :project AND success = 0',
+     'SELECT * FROM pipeline_runs WHERE project = :project AND success = 0'),
+    ('get_projects', 'SELECT DISTINCT project FROM pipeline_runs', 'SELECT DISTINCT project FROM pipeline_runs'),
+    ('get_repos_for_project', 'SELECT DISTINCT repository FROM pipeline_runs WHERE project = :project',
+     'SELECT DISTINCT repository FROM pipeline_runs WHERE project = :project'),
+    ('get_latest_results', LEGACY_LATEST.format(where=''), LATEST.format(where='')),
+    ('get_latest_results_for_project', LEGACY_LATEST.format(where='WHERE project = :project'),
+     LATEST.format(where='WHERE l.project = :project')),
+]
+
+
+def time_queries(engine, params, legacy):
+    """
+    Time each query, fetching every row.
+    :param engine: SQLAlchemy engine
+    :param params: dict of bound parameters
+    :param legacy: time the legacy queries if True, else the migrated ones
+    :return: dict of {getter: (seconds, row count)}
+    """
+    timings = dict()
+    with engine.connect() as conn:
+        for getter, legacy_query, migrated_query in QUERIES:
+            query = text(legacy_query if legacy else migrated_query)
+            elapsed, rows = timed(lambda: conn.execute(query, **params).fetchall())
+            timings[getter] = (elapsed, len(rows))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100000, help='number of pipeline runs to generate')
+    args = parser.parse_args()
+    tempdir = tempfile.mkdtemp()
+    try:
+        dburl = 'sqlite:///{}'.format(os.path.join(tempdir, 'benchmark.db'))
+        engine = create_engine(dburl)
+        results = list(generate_results(args.rows))
+        with engine.begin() as conn:
+            conn.execute(text(LEGACY_SCHEMA))
+            insert = text('INSERT INTO pipeline_runs ({}) VALUES ({})'.format(
+                    ', '.join(COLUMNS), ', '.join(':{}'.format(column) for column in COLUMNS)))
+            conn.execute(insert, [dict((column, str(result.get(column)) if column in ('run_id', 'timestamp')
+                                        else result.get(column)) for column in COLUMNS) for result in results])
+        middle = results[len(results) // 2]
+        legacy_params = {'timestamp': str(middle['timestamp']), 'project': middle['project'],
+                         'repo': middle['repository']}
+        before = time_queries(engine, legacy_params, legacy=True)
+        migration_time, _ = timed(lambda: PipelineResults(dburl), repeat=1)
+        params = dict(legacy_params, timestamp=middle['timestamp'])
+        after = time_queries(engine, params, legacy=False)
+        rows = list()
+        for getter, _, _ in QUERIES:
+            (before_time, before_rows), (after_time, after_rows) = before[getter], after[getter]
+            rows.append([getter, '{:.4f}'.format(before_time), '{:.4f}'.format(after_time),
+                         '{:.1f}x'.format(before_time / max(after_time, 1e-6)), before_rows, after_rows])
+        print('{} rows, migration took {:.2f}s'.format(args.rows, migration_time))
+        print_table(['getter', 'before (s)', 'after (s)', 'speedup', 'rows before', 'rows after'], rows)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare the peak memory and time of serving the full /results/ history as one JSON body against streaming it.
+Each request is served in a fresh process, so peak resident set sizes don't carry over between them.
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from falcon import testing
+
+from benchmarks import generate_results, populate, print_table
+from djinn import Djinn
+
+
+def serve(dburl, query_string, queue):
+    """
+    Serve a single request against a WSGI app, reading the body a chunk at a time and discarding it as a server
+    writing it to a socket would.
+    :param dburl: database connection string
+    :param query_string: query string for the request
+    :param queue: multiprocessing.Queue to put (seconds, bytes served, peak RSS growth in MB) on
+    """
+    app = Djinn(dburl=dburl).create_api()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    size = 0
+    for chunk in app(testing.create_environ(path='/results/', query_string=query_string), lambda *args: None):
+        size += len(chunk)
+    elapsed = time.time() - start
+    queue.put((elapsed, size, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024.0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=200000, help='number of pipeline runs to generate')
+    args = parser.parse_args()
+    tempdir = tempfile.mkdtemp()
+    try:
+        dburl = 'sqlite:///{}'.format(os.path.join(tempdir, 'benchmark.db'))
+        populate(Djinn(dburl=dburl).db, generate_results(args.rows, max_message_repeats=20))
+        rows = list()
+        for mode, query_string in [('single body', ''), ('stream=true', 'stream=true')]:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=serve, args=(dburl, query_string, queue))
+            process.start()
+            elapsed, size, peak = queue.get()
+            process.join()
+            rows.append([mode, '{:.2f}'.format(elapsed), '{:.1f}'.format(size / 1048576.0), '{:.1f}'.format(peak)])
+        print('{} rows'.format(args.rows))
+        print_table(['response', 'time (s)', 'body (MB)', 'peak RSS growth (MB)'], rows)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
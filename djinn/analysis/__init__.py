@@ -6,14 +6,31 @@ def gen_heatmap_with_strategy(analysis_strategy, failures):
     """
     Get the heatmap data for all given failures.
     :param analysis_strategy: a function which takes data and groups by a
-     key in that data.
+     key in that data, or a strategy with a heatmap method which builds the whole heatmap itself, e.g.
+     djinn.analysis.vectorized.vectorized_projects_strategy.
     :param failures: the failures data to generate the heatmap from.
     :return: a dictionary of the data for the x, y and z axes of a heatmap.
     """
     data = [AnalysisData(x.stage_failed, x.project, x.repository) for x in failures]
+    if hasattr(analysis_strategy, 'heatmap'):
+        return analysis_strategy.heatmap(data)
     return _transform_for_heatmap(analysis_strategy)(data)
 
 
+def gen_heatmap_from_counts(counts):
+    """
+    Get the heatmap data from failure counts already aggregated by stage, e.g. by a GROUP BY in the database.
+    The output is identical to gen_heatmap_with_strategy given the failures those counts were taken from.
+    :param counts: iterable of (stage, key, failures) tuples, where key is the project or repo grouped by.
+    :return: a dictionary of the data for the x, y and z axes of a heatmap.
+    """
+    deduped = {}
+    # Build the nested structure in the same order _dedup would, so the axes come out in the same order.
+    for stage, inner, failures in sorted(counts):
+        deduped.setdefault(stage, {})[inner] = failures
+    return _heatmap_from_deduped(deduped)
+
+
 class AnalysisData(object):
     """
     Immutable data object for passing about analysis data.
@@ -65,25 +82,33 @@ def _transform_for_heatmap(analysis_strategy):
     """
 
     def transformer(data):
-        x = []
-        y = OrderedDict()
-        z = []
-        deduped = _dedup(data, analysis_strategy)
-        for stage, details in deduped.items():
-            x.append(stage)
-            for inner in details.keys():
-                y[inner] = True
-        for inner in y.keys():
-            z_next = []
-            for stage in x:
-                failures = deduped.get(stage).get(inner, 0)
-                z_next.append(failures)
-            z.append(z_next)
-        return {"x": x, "y": y.keys(), "z": z}
+        return _heatmap_from_deduped(_dedup(data, analysis_strategy))
 
     return transformer
 
 
+def _heatmap_from_deduped(deduped):
+    """
+    Lay out deduplicated failure counts as the x, y and z axes of a plotly heatmap.
+    :param deduped: dict of {stage: {key: failures}}, as built by _dedup.
+    :return: a dictionary of the data for the x, y and z axes of a heatmap.
+    """
+    x = []
+    y = OrderedDict()
+    z = []
+    for stage, details in deduped.items():
+        x.append(stage)
+        for inner in details.keys():
+            y[inner] = True
+    for inner in y.keys():
+        z_next = []
+        for stage in x:
+            failures = deduped.get(stage).get(inner, 0)
+            z_next.append(failures)
+        z.append(z_next)
+    return {"x": x, "y": y.keys(), "z": z}
+
+
 def _dedup(data, inner_groupby):
     """
     Turn flat list of AnalysisData objects into a nested structure. This
@@ -0,0 +1,50 @@
+"""
+NumPy-backed analysis strategies. Stage and project/repo labels are turned into integer codes and the failure
+matrix is counted in one vectorized pass, rather than sorting and grouping the data in Python.
+NumPy is an optional dependency, not installed by requirements.txt, since the app builds heatmaps from the failure
+counts rollup instead.
+"""
+import numpy as np
+
+from . import projects_stage_inner_groupby, repos_stage_inner_groupby, _heatmap_from_deduped
+
+
+class VectorizedStrategy(object):
+    """
+    Analysis strategy for gen_heatmap_with_strategy which builds the whole heatmap with NumPy. Calling it groups
+    stage data like the strategy it replaces, so it can also be used anywhere a plain strategy is expected.
+    """
+
+    def __init__(self, key, inner_groupby):
+        """
+        :param key: AnalysisData attribute to count failures for within each stage, 'project' or 'repo'
+        :param inner_groupby: the equivalent plain strategy
+        """
+        self.key = key
+        self.inner_groupby = inner_groupby
+
+    def __call__(self, stage_data):
+        return self.inner_groupby(stage_data)
+
+    def heatmap(self, data):
+        """
+        Transform data into the format for a plotly heatmap, with the same axis order as the plain strategy.
+        :param data: list of AnalysisData objects
+        :return: a dictionary of the data for the x, y and z axes of a heatmap.
+        """
+        if not data:
+            return _heatmap_from_deduped({})
+        stages, stage_codes = np.unique(np.array([item.stage for item in data], dtype=object), return_inverse=True)
+        inners, inner_codes = np.unique(np.array([getattr(item, self.key) for item in data], dtype=object),
+                                        return_inverse=True)
+        # Flatten each (stage, inner) pair to a single code so one bincount fills the whole 2-D matrix.
+        counts = np.bincount(stage_codes * len(inners) + inner_codes, minlength=len(stages) * len(inners))
+        counts = counts.reshape(len(stages), len(inners))
+        deduped = {}
+        for stage_index, inner_index in zip(*np.nonzero(counts)):
+            deduped.setdefault(stages[stage_index], {})[inners[inner_index]] = int(counts[stage_index, inner_index])
+        return _heatmap_from_deduped(deduped)
+
+
+vectorized_projects_strategy = VectorizedStrategy('project', projects_stage_inner_groupby)
+vectorized_repos_strategy = VectorizedStrategy('repo', repos_stage_inner_groupby)
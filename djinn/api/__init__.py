@@ -1,6 +1,9 @@
 import falcon
 
-from .resources import HeatmapResource, ResultsResource, ProjectResource
+from .cache import ResponseCache
+from .compression import CompressionMiddleware
+from .resources import HeatmapResource, ResultsResource, ProjectResource, SchedulerResource
+from .sessions import RequestSessionMiddleware
 
 
 class DJinnAPI(falcon.API):
@@ -8,22 +11,33 @@ class DJinnAPI(falcon.API):
     REST API for retrieving pipeline data
     """
 
-    def __init__(self, djenkins, pipeline_results):
+    def __init__(self, djenkins, pipeline_results, cache_size=256, compress_min_size=1024, scheduler=None):
         """
         Initialize the API with instantiated DJenkins, PipelineResults and AnalysisService objects
         :param djenkins: DJenkins instance
         :param pipeline_results: PipelineResults instance
+        :param cache_size: number of rendered responses to cache, or 0 to disable the cache.
+        :param compress_min_size: smallest response body in bytes to compress, or None to disable compression.
+        :param scheduler: PollScheduler instance whose stats are served on /scheduler/, if given.
         """
-        super(self.__class__, self).__init__()
+        compression = CompressionMiddleware(min_size=compress_min_size) if compress_min_size is not None else None
+        middleware = [RequestSessionMiddleware(database=pipeline_results)]
+        if compression:
+            middleware.append(compression)
+        super(self.__class__, self).__init__(middleware=middleware)
+        self.compression = compression
         self.djenkins = djenkins
         self.db = pipeline_results
-        heatmap = HeatmapResource(database=self.db)
+        self.cache = ResponseCache(max_entries=cache_size) if cache_size else None
+        heatmap = HeatmapResource(database=self.db, cache=self.cache)
         self.add_route('/heatmap/', heatmap)
         self.add_route('/heatmap/{project}', heatmap)
-        results = ResultsResource(database=self.db)
+        results = ResultsResource(database=self.db, cache=self.cache)
         self.add_route('/results/', results)
         self.add_route('/results/{project}', results)
         self.add_route('/results/{project}/{repo}', results)
-        projects = ProjectResource(database=self.db)
+        projects = ProjectResource(database=self.db, cache=self.cache)
         self.add_route('/projects/', projects)
         self.add_route('/projects/{project}', projects)
+        if scheduler:
+            self.add_route('/scheduler/', SchedulerResource(scheduler=scheduler))
@@ -0,0 +1,129 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from functools import wraps
+
+import falcon
+
+# encoded holds the body compressed with each content coding it's been served with, filled in as needed.
+CachedResponse = namedtuple('CachedResponse', ['version', 'created', 'body', 'etag', 'last_modified', 'encoded'])
+
+
+class ResponseCache(object):
+    def __init__(self, max_entries=256, max_age=300):
+        """
+        In-process LRU cache of rendered API responses. Entries are tagged with the database's data version when
+        they're rendered and ignored once it changes, so every write to the database, by any instance sharing it,
+        invalidates the whole cache.
+        :param max_entries: number of responses to keep before evicting the least recently used.
+        :param max_age: seconds before an entry is rendered again regardless, since some responses depend on the
+         current time, e.g. results filtered by weeks_ago.
+        """
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1, got {}'.format(max_entries))
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        """
+        Look up a response rendered at the given data version.
+        :param key: cache key as returned by request_key
+        :param version: current data version of the database
+        :return: CachedResponse, or None if there's no current entry
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry.version != version or time.time() - entry.created > self.max_age:
+                return None
+            # Re-insert to mark the entry as most recently used.
+            self.entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        """
+        Store a response, evicting the least recently used entries if the cache is full.
+        :param key: cache key as returned by request_key
+        :param entry: CachedResponse
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+def request_key(req):
+    """
+    Build a cache key from a request's route and query parameters, ignoring the order the parameters were given in.
+    :param req: falcon.Request
+    :return: key as tuple
+    """
+    params = tuple(sorted(param for param in req.query_string.split('&') if param))
+    return req.path, params
+
+
+def _not_modified(req, entry):
+    """
+    Check a request's conditional headers against a cached response. If-None-Match takes precedence over
+    If-Modified-Since when both are sent.
+    :param req: falcon.Request
+    :param entry: CachedResponse
+    :return: True if the client's copy is current
+    """
+    if req.if_none_match is not None:
+        # If-None-Match uses weak comparison, and compressed variants are sent with weak validators.
+        tags = [tag.strip() for tag in req.if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        return entry.etag in tags or '*' in tags
+    if req.if_modified_since is not None:
+        return entry.last_modified <= req.if_modified_since
+    return False
+
+
+def cached_response(responder):
+    """
+    Decorator for a resource's on_get, serving it from the resource's ResponseCache while the database is unchanged.
+    Successful responses carry ETag and Last-Modified headers, and conditional requests for a current copy are
+    answered with 304 Not Modified. Resources need db and cache attributes; with no cache every request is rendered.
+    The entry is left in resp.context['cached_response'] for CompressionMiddleware to keep compressed bodies in.
+    """
+    @wraps(responder)
+    def wrapper(resource, req, resp, **kwargs):
+        cache = resource.cache
+        key = request_key(req)
+        version, modified = resource.db.get_data_version()
+        entry = cache.get(key, version) if cache else None
+        if entry is None:
+            responder(resource, req, resp, **kwargs)
+            if resp.status != falcon.HTTP_200 or resp.body is None:
+                return
+            # HTTP dates only have second precision, so drop anything finer to make If-Modified-Since comparable.
+            last_modified = datetime.utcfromtimestamp(int(modified))
+            etag = '"{}"'.format(hashlib.sha1(resp.body.encode('utf-8')).hexdigest())
+            entry = CachedResponse(version=version, created=time.time(), body=resp.body, etag=etag,
+                                   last_modified=last_modified, encoded=dict())
+            if cache:
+                cache.put(key, entry)
+        resp.context['cached_response'] = entry
+        resp.etag = entry.etag
+        resp.last_modified = entry.last_modified
+        if _not_modified(req, entry):
+            resp.status = falcon.HTTP_304
+            resp.body = None
+        else:
+            resp.status = falcon.HTTP_200
+            resp.body = entry.body
+    return wrapper
@@ -0,0 +1,99 @@
+import gzip
+from io import BytesIO
+
+import falcon
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def gzip_compress(data):
+    """
+    Compress bytes with gzip. The modification time is fixed so the same body always compresses identically.
+    :param data: bytes to compress
+    :return: compressed bytes
+    """
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0) as compressed:
+        compressed.write(data)
+    return buf.getvalue()
+
+
+def available_encodings():
+    """
+    List the content codings we can produce, most preferred first. Brotli is only offered if it's installed.
+    :return: dict of {coding: compression function}, and list of codings in order of preference
+    """
+    encoders = {'gzip': gzip_compress}
+    preference = ['gzip']
+    if brotli is not None:
+        encoders['br'] = brotli.compress
+        preference.insert(0, 'br')
+    return encoders, preference
+
+
+def negotiate_encoding(accept_encoding, preference):
+    """
+    Choose a content coding from an Accept-Encoding header.
+    :param accept_encoding: Accept-Encoding header value, or None
+    :param preference: list of codings we can produce, most preferred first
+    :return: chosen coding, or None to send the body uncompressed
+    """
+    if not accept_encoding:
+        return None
+    qualities = dict()
+    for item in accept_encoding.split(','):
+        parts = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        qualities[parts[0].lower()] = quality
+    best = None
+    for coding in preference:
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (coding, quality)
+    return best[0] if best else None
+
+
+class CompressionMiddleware(object):
+    def __init__(self, min_size=1024):
+        """
+        Falcon middleware compressing response bodies for clients that accept it. Responses served by
+        cached_response keep their compressed bytes in the cache entry, so each body is only compressed once per
+        coding. Streamed responses are left alone.
+        :param min_size: smallest body in bytes worth compressing.
+        """
+        self.min_size = min_size
+        self.encoders, self.preference = available_encodings()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        entry = resp.context.get('cached_response')
+        body = entry.body if entry is not None else resp.body
+        if body is None or len(body) < self.min_size:
+            return
+        resp.vary = ['Accept-Encoding']
+        coding = negotiate_encoding(req.get_header('Accept-Encoding'), self.preference)
+        if coding is None:
+            return
+        # The compressed bytes differ from the identity body, so the validator can only be a weak match for it.
+        etag = resp.get_header('ETag')
+        if etag and not etag.startswith('W/'):
+            resp.etag = 'W/{}'.format(etag)
+        if resp.status == falcon.HTTP_304 or resp.body is None:
+            return
+        if entry is not None:
+            data = entry.encoded.get(coding)
+            if data is None:
+                data = entry.encoded[coding] = self.encoders[coding](entry.body.encode('utf-8'))
+        else:
+            data = self.encoders[coding](resp.body.encode('utf-8'))
+        resp.data = data
+        resp.body = None
+        resp.set_header('Content-Encoding', coding)
@@ -1,23 +1,89 @@
+import base64
 import json
 
 import falcon
 
-from ..analysis import gen_heatmap_with_strategy, projects_stage_inner_groupby, repos_stage_inner_groupby
-from ..djinnutils import get_epoch_time_of_weeks_ago
+from .cache import cached_response
+from ..analysis import gen_heatmap_from_counts
+from ..database.entity import PipelineRun
+from ..djinnutils import get_epoch_time_of_weeks_ago, chunked_iter
 
+# Page size used when a cursor is given without a limit, and the largest page a client can ask for.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Number of results serialized into each chunk of a streamed response.
+STREAM_CHUNK_SIZE = 500
+# Columns which can be requested with the fields parameter.
+RESULT_FIELDS = [column.name for column in PipelineRun.__table__.columns]
 
-def format_results(resultlist):
+
+def format_result(item, fields=None):
+    """
+    Take a single SQLAlchemy DB object or row and convert it to a dict of its columns.
+    :param item: stage result
+    :param fields: only include these columns and the ID if given, as a list of names
+    :return: formatted dict of the result
     """
-    Take a list of SQLAlchemy DB objects and arrange them into a flat list.
+    if hasattr(item, '_asdict'):
+        item = item._asdict()
+    else:
+        item = dict(item.__dict__)
+        item.pop('_sa_instance_state')
+    if fields:
+        item = dict((key, value) for key, value in item.items() if key in fields or key == 'id')
+    return item
+
+
+def format_results(resultlist, fields=None):
+    """
+    Take a list of SQLAlchemy DB objects or rows and arrange them into a flat list.
     :param resultlist: list of stage results
+    :param fields: only include these columns and the ID if given, as a list of names
     :return: formatted dict of results
     """
-    output = list()
-    for item in resultlist:
-        item = item.__dict__
-        item.pop('_sa_instance_state')
-        output.append(item)
-    return output
+    return [format_result(item, fields) for item in resultlist]
+
+
+def stream_results(results, fields=None):
+    """
+    Serialize results as a JSON document matching json.dumps({'results': format_results(results)}), a chunk of
+    results at a time, so the whole document is never held in memory.
+    :param results: iterable of stage results
+    :param fields: only include these columns and the ID if given, as a list of names
+    :return: generator of strings
+    """
+    yield '{"results": ['
+    separator = ''
+    for chunk in chunked_iter(results, STREAM_CHUNK_SIZE):
+        yield separator + ', '.join(json.dumps(format_result(item, fields)) for item in chunk)
+        separator = ', '
+    yield ']}'
+
+
+def encode_cursor(key):
+    """
+    Encode the (timestamp, id) key of the last result on a page as an opaque, URL safe cursor.
+    :param key: tuple of (timestamp, id)
+    :return: cursor as string
+    """
+    return base64.urlsafe_b64encode(json.dumps(list(key))).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by encode_cursor.
+    :param cursor: cursor as string
+    :raises: ValueError if the cursor is malformed
+    :return: tuple of (timestamp, id)
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Malformed cursor: {}'.format(cursor))
+    if not isinstance(key, list) or len(key) != 2 or not isinstance(key[0], (int, long)) or \
+            not isinstance(key[1], basestring):
+        raise ValueError('Malformed cursor: {}'.format(cursor))
+    return key[0], key[1]
 
 
 def set_cors_header(req, resp, resource):
@@ -33,19 +99,19 @@ class HeatmapResource(object):
     REST resource for heatmap data
     """
 
-    def __init__(self, database):
+    def __init__(self, database, cache=None):
         self.db = database
+        self.cache = cache
 
+    @cached_response
     def on_get(self, req, resp, project=None):
         if project is None:
-            failures = self.db.get_all_failures()
-            resp.body = json.dumps(
-                    gen_heatmap_with_strategy(projects_stage_inner_groupby, failures))
+            counts = self.db.get_failure_counts(group_by='project')
+            resp.body = json.dumps(gen_heatmap_from_counts(counts))
             resp.status = falcon.HTTP_200
         else:
-            failures = self.db.get_failed_results_for_project(project)
-            resp.body = json.dumps(
-                    gen_heatmap_with_strategy(repos_stage_inner_groupby, failures))
+            counts = self.db.get_failure_counts(group_by='repository', project=project)
+            resp.body = json.dumps(gen_heatmap_from_counts(counts))
             resp.status = falcon.HTTP_200
 
 
@@ -55,9 +121,11 @@ class ResultsResource(object):
     REST resource for raw results
     """
 
-    def __init__(self, database):
+    def __init__(self, database, cache=None):
         self.db = database
+        self.cache = cache
 
+    @cached_response
     def on_get(self, req, resp, project=None, repo=None):
         if project:
             if not self.db.check_project_exists(project):
@@ -68,20 +136,66 @@ class ResultsResource(object):
         latest = req.get_param_as_bool(name='latest', required=False)
         weeks_ago = req.get_param_as_int(name='weeks_ago', required=False)
         target_timestamp = get_epoch_time_of_weeks_ago(weeks=weeks_ago)
+        limit = req.get_param_as_int(name='limit', required=False, min=1)
+        cursor = req.get_param(name='cursor', required=False)
+        stream = req.get_param_as_bool(name='stream', required=False)
+        fields = req.get_param_as_list(name='fields', required=False)
+        branch = req.get_param(name='branch', required=False)
+        source = req.get_param(name='source', required=False)
+        unknown = [field for field in fields or list() if field not in RESULT_FIELDS]
+        if unknown:
+            resp.body = json.dumps({'Error': 'Unknown fields {}, expected any of {}'.format(
+                    ', '.join(unknown), ', '.join(RESULT_FIELDS))})
+            resp.status = falcon.HTTP_400
+            return
+
+        if not latest and (limit or cursor):
+            self._get_page(resp, project=project, repo=repo, timestamp=target_timestamp, limit=limit, cursor=cursor,
+                           fields=fields, branch=branch, source=source)
+            return
+        if not latest and stream:
+            # Streamed responses are never cached, since holding them in the cache would defeat the point.
+            if project and repo:
+                results = self.db.iter_result_rows(reponame=repo, timestamp=target_timestamp, fields=fields,
+                                                   branch=branch, source=source)
+            else:
+                results = self.db.iter_result_rows(project=project, timestamp=target_timestamp, fields=fields,
+                                                   branch=branch, source=source)
+            resp.stream = stream_results(results, fields)
+            resp.status = falcon.HTTP_200
+            return
+        if project and repo:
+            results = self.db.get_result_rows(reponame=repo, timestamp=target_timestamp, fields=fields, branch=branch,
+                                              source=source)
+        elif latest:
+            results = self.db.get_latest_result_rows(project=project, fields=fields, branch=branch, source=source)
+        else:
+            results = self.db.get_result_rows(project=project, timestamp=target_timestamp, fields=fields,
+                                              branch=branch, source=source)
+        resp.body = json.dumps({'results': format_results(results, fields)})
+        resp.status = falcon.HTTP_200
 
+    def _get_page(self, resp, project, repo, timestamp, limit, cursor, fields=None, branch=None, source=None):
+        """
+        Respond with one page of results, newest first, along with a cursor for the next page or None on the last.
+        """
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as err:
+            resp.body = json.dumps({'Error': str(err)})
+            resp.status = falcon.HTTP_400
+            return
+        limit = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
         if project and repo:
-            results = self.db.get_results_for_repo(reponame=repo, timestamp=target_timestamp)
-        elif project:
-            if latest:
-                results = self.db.get_latest_results_for_project(project=project)
-            else:
-                results = self.db.get_results_for_project(project=project, timestamp=target_timestamp)
+            results, next_key = self.db.get_result_rows_page(limit=limit, after=after, reponame=repo,
+                                                             timestamp=timestamp, fields=fields, branch=branch,
+                                                             source=source)
         else:
-            if latest:
-                results = self.db.get_latest_results()
-            else:
-                results = self.db.get_all_results(timestamp=target_timestamp)
-        resp.body = json.dumps({'results': format_results(results)})
+            results, next_key = self.db.get_result_rows_page(limit=limit, after=after, project=project,
+                                                             timestamp=timestamp, fields=fields, branch=branch,
+                                                             source=source)
+        next_cursor = encode_cursor(next_key) if next_key else None
+        resp.body = json.dumps({'results': format_results(results, fields), 'next_cursor': next_cursor})
         resp.status = falcon.HTTP_200
 
 
@@ -91,9 +205,11 @@ class ProjectResource(object):
     REST resource for available projects, or a list of repositories for a given project
     """
 
-    def __init__(self, database):
+    def __init__(self, database, cache=None):
         self.db = database
+        self.cache = cache
 
+    @cached_response
     def on_get(self, req, resp, project=None):
         if project:
             if not self.db.check_project_exists(project):
@@ -109,3 +225,17 @@ class ProjectResource(object):
             body = {'projects': projects}
         resp.body = json.dumps(body)
         resp.status = falcon.HTTP_200
+
+
+@falcon.after(set_cors_header)
+class SchedulerResource(object):
+    """
+    REST resource for the polling scheduler's queue depth and lag
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def on_get(self, req, resp):
+        resp.body = json.dumps(self.scheduler.stats())
+        resp.status = falcon.HTTP_200
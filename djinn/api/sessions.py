@@ -0,0 +1,14 @@
+class RequestSessionMiddleware(object):
+    def __init__(self, database):
+        """
+        Falcon middleware giving each request a single database session, shared by every PipelineResults read the
+        request makes, so it checks out at most one pooled connection.
+        :param database: PipelineResults instance
+        """
+        self.db = database
+
+    def process_request(self, req, resp):
+        self.db.begin_request()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        self.db.end_request()
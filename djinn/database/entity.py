@@ -1,26 +1,144 @@
-from sqlalchemy import Column, String, Boolean
+from sqlalchemy import Column, String, Boolean, Integer, BigInteger, Index
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# InnoDB limits an index key to 3072 bytes, and utf8mb4 reserves 4 bytes per character, so the source and branch
+# columns of latest_runs' primary key are shorter than the rest to fit alongside a full project and repository name.
+SOURCE_NAME_LENGTH = 64
+BRANCH_NAME_LENGTH = 191
+
 
 class PipelineRun(Base):
     __tablename__ = 'pipeline_runs'
+    __table_args__ = (Index('ix_pipeline_runs_project_repository_run_id', 'project', 'repository', 'run_id'),
+                      Index('ix_pipeline_runs_success_project', 'success', 'project'),
+                      Index('ix_pipeline_runs_timestamp_id', 'timestamp', 'id'),
+                      Index('ix_pipeline_runs_branch', 'branch'),
+                      Index('ix_pipeline_runs_source', 'source'))
     id = Column(String(length=255), primary_key=True)
-    run_id = Column(String(length=255))
+    source = Column(String(length=255))
+    run_id = Column(Integer)
     project = Column(String(length=255))
     repository = Column(String(length=255))
+    branch = Column(String(length=255))
     status = Column(String(length=255))
-    timestamp = Column(String(length=255))
+    timestamp = Column(BigInteger)
     success = Column(Boolean)
     stage_failed = Column(String(length=255))
     error_type = Column(String(length=255))
     error_message = Column(String(length=4096))
 
     def __repr__(self):
-        reprstr = ("<PipelineRun(id={id}, run_id={run_id}, project={project}, repository={repository}, "
-                   "status={status}, timestamp={timestamp}, success={success}, stage_failed={stage_failed}, "
-                   "error_type={error_type})>")
-        return reprstr.format(id=self.id, run_id=self.run_id, project=self.project, repository=self.repository,
-                              status=self.status, timestamp=self.timestamp, success=self.success,
-                              stage_failed=self.stage_failed, error_type=self.error_type)
+        reprstr = ("<PipelineRun(id={id}, source={source}, run_id={run_id}, project={project}, "
+                   "repository={repository}, branch={branch}, status={status}, timestamp={timestamp}, "
+                   "success={success}, stage_failed={stage_failed}, error_type={error_type})>")
+        return reprstr.format(id=self.id, source=self.source, run_id=self.run_id, project=self.project,
+                              repository=self.repository, branch=self.branch, status=self.status,
+                              timestamp=self.timestamp, success=self.success, stage_failed=self.stage_failed,
+                              error_type=self.error_type)
+
+
+class LatestRun(Base):
+    """
+    Latest run stored for each branch of each repository of each Jenkins source, kept up to date on ingest so the
+    latest results can be read without scanning history. Its run ID is also the high-water mark used to skip branches
+    that haven't built since. Runs stored before branches were recorded are tracked under an empty branch name, and
+    runs from the unnamed source under an empty source name.
+    """
+    __tablename__ = 'latest_runs'
+    source = Column(String(length=SOURCE_NAME_LENGTH), primary_key=True)
+    project = Column(String(length=255), primary_key=True)
+    repository = Column(String(length=255), primary_key=True)
+    branch = Column(String(length=BRANCH_NAME_LENGTH), primary_key=True)
+    run_id = Column(Integer)
+    result_id = Column(String(length=255))
+
+    def __repr__(self):
+        reprstr = ("<LatestRun(source={source}, project={project}, repository={repository}, branch={branch}, "
+                   "run_id={run_id}, result_id={result_id})>")
+        return reprstr.format(source=self.source, project=self.project, repository=self.repository, branch=self.branch,
+                              run_id=self.run_id, result_id=self.result_id)
+
+
+class OpenRun(Base):
+    """
+    Pipeline runs stored while still IN_PROGRESS, which need refreshing until they finish.
+    """
+    __tablename__ = 'open_runs'
+    id = Column(String(length=255), primary_key=True)
+    source = Column(String(length=255))
+    run_id = Column(Integer)
+    project = Column(String(length=255))
+    repository = Column(String(length=255))
+    branch = Column(String(length=255))
+
+    def __repr__(self):
+        reprstr = ("<OpenRun(id={id}, source={source}, run_id={run_id}, project={project}, repository={repository}, "
+                   "branch={branch})>")
+        return reprstr.format(id=self.id, source=self.source, run_id=self.run_id, project=self.project,
+                              repository=self.repository, branch=self.branch)
+
+
+class FailureCount(Base):
+    """
+    Failed runs counted per project, repository, stage and day, kept up to date on ingest so heatmaps can be
+    built without scanning history. Runs which failed outside of a stage are counted under an empty stage name.
+    """
+    __tablename__ = 'failure_counts'
+    project = Column(String(length=255), primary_key=True)
+    repository = Column(String(length=255), primary_key=True)
+    stage_failed = Column(String(length=255), primary_key=True)
+    day = Column(Integer, primary_key=True, autoincrement=False)
+    failures = Column(Integer)
+
+    def __repr__(self):
+        reprstr = ("<FailureCount(project={project}, repository={repository}, stage_failed={stage_failed}, "
+                   "day={day}, failures={failures})>")
+        return reprstr.format(project=self.project, repository=self.repository, stage_failed=self.stage_failed,
+                              day=self.day, failures=self.failures)
+
+
+class Crawler(Base):
+    """
+    Crawler instances currently running against this database, each registered until it expires unless renewed,
+    so instances can tell how many others they're sharing the crawl with.
+    """
+    __tablename__ = 'crawlers'
+    owner = Column(String(length=255), primary_key=True)
+    expires = Column(BigInteger)
+
+    def __repr__(self):
+        return "<Crawler(owner={owner}, expires={expires})>".format(owner=self.owner, expires=self.expires)
+
+
+class CrawlLease(Base):
+    """
+    Leases on project folders, giving one crawler instance at a time the right to poll a folder's repositories.
+    A lease which expires without being renewed, e.g. because its owner died, can be taken over by another instance.
+    Expiry times are in epoch milliseconds.
+    """
+    __tablename__ = 'crawl_leases'
+    folder = Column(String(length=255), primary_key=True)
+    owner = Column(String(length=255))
+    expires = Column(BigInteger)
+
+    def __repr__(self):
+        reprstr = "<CrawlLease(folder={folder}, owner={owner}, expires={expires})>"
+        return reprstr.format(folder=self.folder, owner=self.owner, expires=self.expires)
+
+
+class DataVersion(Base):
+    """
+    Counter bumped in the same transaction as every write to the results, along with when it was made, so every
+    instance sharing the database can tell whether anything it has derived from them, e.g. a cached response, is
+    stale. Modified times are in epoch milliseconds.
+    """
+    __tablename__ = 'data_versions'
+    name = Column(String(length=255), primary_key=True)
+    version = Column(BigInteger)
+    modified = Column(BigInteger)
+
+    def __repr__(self):
+        reprstr = "<DataVersion(name={name}, version={version}, modified={modified})>"
+        return reprstr.format(name=self.name, version=self.version, modified=self.modified)
@@ -0,0 +1,182 @@
+from sqlalchemy import inspect, cast, select, text, Integer, MetaData, Table, String
+from sqlalchemy.schema import CreateIndex
+
+from .entity import Base
+from ..djinnutils.loggers import get_named_logger
+
+# Tables created by earlier versions which have since been replaced.
+OBSOLETE_TABLES = ['repo_high_water_marks']
+# Indexes created by earlier versions which have since been replaced, by table name.
+OBSOLETE_INDEXES = {'pipeline_runs': ['ix_pipeline_runs_timestamp']}
+# Tables derived from pipeline_runs, which are rebuilt from it rather than altered when their columns change.
+# Their primary keys must fit InnoDB's 3072 byte key limit at 4 bytes per character for utf8mb4, e.g. latest_runs
+# keys on a 64 character source and 191 character branch alongside 255 character project and repository names.
+DERIVED_TABLES = ['open_runs', 'latest_runs', 'failure_counts']
+
+
+def drop_outdated_derived_tables(engine, logger=None):
+    """
+    Drop derived tables missing columns our entities define, e.g. a new primary key column, or whose primary key
+    columns' lengths have changed, e.g. shortened to fit MySQL's key length limit, so they're created again and
+    rebuilt from pipeline_runs. Must run before create_all.
+    :param engine: SQLAlchemy engine for the target database
+    :param logger: Logger instance, or None to create one
+    :return: list of table names dropped
+    """
+    if not logger:
+        logger = get_named_logger('Migration')
+    dropped = list()
+    with engine.begin() as conn:
+        for name in DERIVED_TABLES:
+            if not engine.dialect.has_table(conn, name):
+                continue
+            table = Base.metadata.tables[name]
+            stored = dict((column['name'], column['type']) for column in inspect(conn).get_columns(name))
+            resized = [column.name for column in table.primary_key
+                       if getattr(stored.get(column.name), 'length', None) != getattr(column.type, 'length', None)]
+            if set(table.columns.keys()) - set(stored) or resized:
+                logger.info('Dropping outdated table {} to rebuild it'.format(name))
+                Table(name, MetaData()).drop(conn)
+                dropped.append(name)
+    return dropped
+
+
+def migrate(engine, logger=None):
+    """
+    Bring the schema of an existing database up to date with our entities. Tables are expected to exist already,
+    e.g. via create_all, which creates missing tables but never alters existing ones.
+    Columns stored as strings by earlier versions are converted to integers, missing columns are added, obsolete
+    indexes are dropped and missing indexes are created.
+    MySQL alters tables in place, allowing reads to continue while it runs. SQLite can't change a column's
+    type, so the table is rebuilt and its rows copied across instead.
+    :param engine: SQLAlchemy engine for the target database
+    :param logger: Logger instance, or None to create one
+    """
+    if not logger:
+        logger = get_named_logger('Migration')
+    with engine.begin() as conn:
+        for name in OBSOLETE_TABLES:
+            if engine.dialect.has_table(conn, name):
+                logger.info('Dropping obsolete table {}'.format(name))
+                Table(name, MetaData()).drop(conn)
+    for table in Base.metadata.sorted_tables:
+        with engine.begin() as conn:
+            retyped = _get_columns_stored_as_strings(conn, table)
+            if retyped:
+                logger.info('Converting {} columns {} to integers'.format(table.name, ', '.join(retyped)))
+                if engine.dialect.name == 'mysql':
+                    _retype_mysql_columns(conn, table, retyped)
+                elif engine.dialect.name == 'sqlite':
+                    _rebuild_sqlite_table(conn, table, retyped)
+                else:
+                    raise NotImplementedError('No migration available for dialect {}'.format(engine.dialect.name))
+        with engine.begin() as conn:
+            _add_missing_columns(conn, table, logger)
+            _drop_obsolete_indexes(conn, table, logger)
+            _create_missing_indexes(conn, table, logger)
+
+
+def _get_columns_stored_as_strings(conn, table):
+    """
+    Find integer columns which are stored as strings in the database.
+    :param conn: database connection
+    :param table: Table as defined by our entities
+    :return: list of column names
+    """
+    stored = dict((column['name'], column['type']) for column in inspect(conn).get_columns(table.name))
+    return [column.name for column in table.columns
+            if isinstance(column.type, Integer) and isinstance(stored.get(column.name), String)]
+
+
+def _retype_mysql_columns(conn, table, retyped):
+    """
+    Change column types in place. LOCK=SHARED keeps the table readable while MySQL copies it.
+    :param conn: database connection
+    :param table: Table as defined by our entities
+    :param retyped: list of column names to change to their entity type
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    changes = ['MODIFY {} {}'.format(quote(name), table.c[name].type.compile(dialect=conn.dialect))
+               for name in retyped]
+    ddl = 'ALTER TABLE {} {}, ALGORITHM=COPY, LOCK=SHARED'.format(quote(table.name), ', '.join(changes))
+    conn.execute(text(ddl))
+
+
+def _rebuild_sqlite_table(conn, table, retyped):
+    """
+    Recreate a table with its entity definition and copy its rows across, casting columns as needed.
+    :param conn: database connection
+    :param table: Table as defined by our entities
+    :param retyped: list of column names to cast to their entity type
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    legacy_name = '{}_legacy'.format(table.name)
+    # Index names are global in SQLite, so drop the old table's before creating the new one's.
+    for index in inspect(conn).get_indexes(table.name):
+        conn.execute(text('DROP INDEX {}'.format(quote(index['name']))))
+    conn.execute(text('ALTER TABLE {} RENAME TO {}'.format(quote(table.name), quote(legacy_name))))
+    legacy = Table(legacy_name, MetaData(), autoload_with=conn)
+    table.create(conn)
+    columns = [column.name for column in table.columns if column.name in legacy.c]
+    rows = select([cast(legacy.c[name], table.c[name].type) if name in retyped else legacy.c[name]
+                   for name in columns])
+    conn.execute(table.insert().from_select(columns, rows))
+    legacy.drop(conn)
+
+
+def _add_missing_columns(conn, table, logger):
+    """
+    Add columns defined on a table's entity which don't yet exist in the database. Existing rows get NULLs.
+    :param conn: database connection
+    :param table: Table as defined by our entities
+    :param logger: Logger instance
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    stored = set(column['name'] for column in inspect(conn).get_columns(table.name))
+    for column in table.columns:
+        if column.name in stored:
+            continue
+        logger.info('Adding column {} to {}'.format(column.name, table.name))
+        conn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                quote(table.name), quote(column.name), column.type.compile(dialect=conn.dialect))))
+
+
+def _drop_obsolete_indexes(conn, table, logger):
+    """
+    Drop indexes on a table which earlier versions created and our entities no longer define.
+    MySQL drops them in place without locking the table.
+    :param conn: database connection
+    :param table: Table as defined by our entities
+    :param logger: Logger instance
+    """
+    quote = conn.dialect.identifier_preparer.quote
+    existing = set(index['name'] for index in inspect(conn).get_indexes(table.name))
+    for name in OBSOLETE_INDEXES.get(table.name, list()):
+        if name not in existing:
+            continue
+        logger.info('Dropping obsolete index {} on {}'.format(name, table.name))
+        if conn.dialect.name == 'mysql':
+            conn.execute(text('DROP INDEX {} ON {} ALGORITHM=INPLACE LOCK=NONE'.format(quote(name),
+                                                                                     quote(table.name))))
+        else:
+            conn.execute(text('DROP INDEX {}'.format(quote(name))))
+
+
+def _create_missing_indexes(conn, table, logger):
+    """
+    Create any indexes defined on a table's entity which don't yet exist in the database.
+    MySQL builds them in place without locking the table.
+    :param conn: database connection
+    :param table: Table as defined by our entities
+    :param logger: Logger instance
+    """
+    existing = set(index['name'] for index in inspect(conn).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        logger.info('Creating index {} on {}'.format(index.name, table.name))
+        if conn.dialect.name == 'mysql':
+            ddl = '{} ALGORITHM=INPLACE LOCK=NONE'.format(CreateIndex(index).compile(dialect=conn.dialect))
+            conn.execute(text(ddl))
+        else:
+            index.create(conn)
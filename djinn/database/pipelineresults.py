@@ -1,35 +1,259 @@
-from sqlalchemy import create_engine
-from sqlalchemy import func, cast, Integer, String
-from sqlalchemy.orm import sessionmaker
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from .entity import PipelineRun
+from sqlalchemy import create_engine, event
+from sqlalchemy import and_, or_, func, select, cast, Integer, String
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, load_only
+from sqlalchemy.pool import StaticPool
+
+from .entity import PipelineRun, LatestRun, OpenRun, FailureCount, Crawler, CrawlLease, DataVersion
+from .migration import migrate, drop_outdated_derived_tables
+from ..djinnutils import chunked
+
+IN_PROGRESS = 'IN_PROGRESS'
+# Keep the number of bound parameters per statement below SQLite's default limit of 999.
+IN_QUERY_CHUNK_SIZE = 500
+INSERT_CHUNK_SIZE = 75
+MS_PER_DAY = 86400000
+# Stored in place of a missing stage name in failure_counts, whose primary key can't contain NULLs.
+NO_STAGE = ''
+# Stored in latest_runs for runs saved before branches were recorded, for the same reason.
+NO_BRANCH = ''
+# Stored in latest_runs for runs from the unnamed Jenkins source, for the same reason.
+NO_SOURCE = ''
+# Name of the data_versions row bumped by every write to the results.
+RESULTS_VERSION = 'results'
+# Applied to every connection to a SQLite database file. WAL lets readers carry on while a write is in progress,
+# NORMAL sync is safe with WAL, and a larger page cache and memory mapped reads speed up scans.
+SQLITE_PRAGMAS = ['journal_mode=WAL', 'synchronous=NORMAL', 'cache_size=-16384', 'mmap_size=134217728']
+# Seconds a SQLite connection waits for another process's lock before giving up.
+SQLITE_BUSY_TIMEOUT = 30
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Connect event listener applying SQLITE_PRAGMAS.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA {}'.format(pragma))
+    cursor.close()
+
+
+def _is_sqlite_file(connection_url):
+    """
+    Check whether a connection URL points at a SQLite database file, rather than an in-memory database or a server.
+    :param connection_url: connection url as string
+    :return: boolean
+    """
+    url = make_url(connection_url)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def _create_engine(connection_url, writer=False, pool_size=None, max_overflow=None, **options):
+    """
+    Create an engine configured for its dialect. Connections to SQLite database files get SQLITE_PRAGMAS, and a
+    writer engine keeps one connection which can be shared between threads. SQLite's default pools don't take a
+    size, they keep a single connection per thread or none at all, so pool sizing only applies to servers.
+    :param connection_url: connection url as string
+    :param writer: create the dedicated writer engine for a SQLite database file
+    :param pool_size: number of connections kept open, or None for SQLAlchemy's default
+    :param max_overflow: connections allowed beyond pool_size, or None for SQLAlchemy's default
+    :param options: further keyword arguments for create_engine
+    :return: Engine
+    """
+    if _is_sqlite_file(connection_url):
+        options['connect_args'] = {'timeout': SQLITE_BUSY_TIMEOUT}
+        if writer:
+            options['poolclass'] = StaticPool
+            options['connect_args']['check_same_thread'] = False
+        engine = create_engine(connection_url, **options)
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
+        return engine
+    if make_url(connection_url).get_backend_name() != 'sqlite':
+        if pool_size is not None:
+            options['pool_size'] = pool_size
+        if max_overflow is not None:
+            options['max_overflow'] = max_overflow
+    return create_engine(connection_url, **options)
 
 
 class PipelineResults(object):
-    def __init__(self, connection_url, echo=False):
+    def __init__(self, connection_url, echo=False, pool_size=None, max_overflow=None, pool_recycle=-1,
+                 pool_pre_ping=False, read_connection_url=None, read_your_writes_window=10):
         """
         Initialize the database if required, and create a sessionmaker bound to our conn URL.
+        get_data_version reports a counter incremented by every write committed to the results, and when the last was
+        made, so callers can tell whether anything they've derived from the database is stale. Both are kept in the
+        database, so writes made by every instance sharing it are seen.
+        SQLite allows a single writer at a time, so writes to a database file go through one dedicated connection,
+        shared between threads and serialized by a lock, while reads use their own connections and see the last
+        committed state until a write commits.
         :param connection_url: connection url for target database
         :param echo: echo all commands to logs
+        :param pool_size: number of connections kept open, or None for SQLAlchemy's default. Ignored for SQLite.
+        :param max_overflow: connections allowed beyond pool_size under load, or None for SQLAlchemy's default.
+         Ignored for SQLite.
+        :param pool_recycle: seconds after which a connection is replaced rather than reused, or -1 to never
+         replace them. Set below the server's idle timeout so we never use a connection it has dropped.
+        :param pool_pre_ping: test each connection as it's checked out, reconnecting if it's gone stale.
+        :param read_connection_url: connection url for a read-only replica of the target database, which reads are
+         routed to if given. The schema is only created and migrated on the target database.
+        :param read_your_writes_window: seconds after this instance commits a write during which reads go to the
+         target database instead of the replica, so they see the write even if the replica is lagging.
         """
         if not connection_url:
             raise ValueError('No database connection URL provided.')
-        engine = create_engine(connection_url, echo=echo)
-        PipelineRun.metadata.create_all(engine)
+        self.last_write = None
+        self.read_your_writes_window = read_your_writes_window
+        self._request_scope = threading.local()
+        options = dict(echo=echo, pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle,
+                       pool_pre_ping=pool_pre_ping)
+        engine = _create_engine(connection_url, **options)
+        self._write_lock = None
+        writer = engine
+        if _is_sqlite_file(connection_url):
+            writer = _create_engine(connection_url, writer=True, **options)
+            self._write_lock = threading.Lock()
+        drop_outdated_derived_tables(writer)
+        with writer.connect() as conn:
+            new_tables = [name for name in PipelineRun.metadata.tables if not writer.dialect.has_table(conn, name)]
+        PipelineRun.metadata.create_all(writer)
+        migrate(writer)
         self.session_factory = sessionmaker(bind=engine)
+        self.write_session_factory = sessionmaker(bind=writer)
+        self.replica_session_factory = None
+        if read_connection_url:
+            self.replica_session_factory = sessionmaker(bind=_create_engine(read_connection_url, **options))
+        self._create_data_version()
+        # Populate tables derived from pipeline_runs when they're added to an existing database.
+        if OpenRun.__tablename__ in new_tables:
+            self._track_existing_open_runs()
+        if LatestRun.__tablename__ in new_tables:
+            self.rebuild_latest_runs()
+        if FailureCount.__tablename__ in new_tables:
+            self.rebuild_failure_counts()
 
-    def _check_row_exists(self, pk):
+    def _create_data_version(self):
+        """
+        Add the data_versions row for the results if it's missing, e.g. in a new database.
+        """
+        with self._write_session() as session:
+            if session.query(DataVersion).get(RESULTS_VERSION) is not None:
+                return
+            session.add(DataVersion(name=RESULTS_VERSION, version=0, modified=int(time.time() * 1000)))
+            try:
+                session.commit()
+            except IntegrityError:
+                # Another instance added it first.
+                session.rollback()
+
+    def _bump_data_version(self, session):
         """
-        Check if the row is already in the database using the primary key
-        :param pk: primary key to search
-        :return: status as boolean
+        Record a write in the same transaction as the write itself, so it's seen by every instance once committed.
+        :param session: session the write is being made in, before it's committed
         """
-        session = self.session_factory()
-        exists = session.query(PipelineRun).filter_by(id=pk).first()
-        session.close()
-        if exists:
-            return True
-        return False
+        table = DataVersion.__table__
+        session.execute(table.update().where(table.c.name == RESULTS_VERSION).values(
+                version=table.c.version + 1, modified=int(time.time() * 1000)))
+        self.last_write = time.time()
+
+    def get_data_version(self):
+        """
+        Report how many writes have been committed to the results, by any instance, and when the last was.
+        :return: tuple of (version as int, last modified time in epoch seconds)
+        """
+        with self._read_session() as session:
+            row = session.query(DataVersion.version, DataVersion.modified).filter(
+                    DataVersion.name == RESULTS_VERSION).first()
+        if row is None:
+            # Not created on a replica yet.
+            return 0, 0
+        return row.version, row.modified / 1000.0
+
+    @property
+    def data_version(self):
+        """
+        Number of writes committed to the results by any instance sharing the database.
+        """
+        return self.get_data_version()[0]
+
+    def _read_session_factory(self):
+        """
+        Choose the sessionmaker for reads: the replica if there is one, unless this instance has written within
+        the read-your-writes window, in which case the target database.
+        :return: sessionmaker
+        """
+        if self.replica_session_factory is None:
+            return self.session_factory
+        if self.last_write is not None and time.time() - self.last_write < self.read_your_writes_window:
+            return self.session_factory
+        return self.replica_session_factory
+
+    def begin_request(self):
+        """
+        Start sharing one session between every read made by this thread, e.g. for the duration of an API request,
+        so the request checks out at most one connection. Must be paired with end_request.
+        """
+        self._request_scope.session = self._read_session_factory()()
+
+    def end_request(self):
+        """
+        Close the session shared since begin_request, returning its connection to the pool.
+        """
+        session = getattr(self._request_scope, 'session', None)
+        self._request_scope.session = None
+        if session is not None:
+            session.close()
+
+    @contextmanager
+    def _read_session(self):
+        """
+        Provide a session for a read: this thread's request session if begin_request has been called, which is
+        left open for the rest of the request, or else a new session which is closed afterwards.
+        """
+        session = getattr(self._request_scope, 'session', None)
+        if session is not None:
+            yield session
+            return
+        session = self._read_session_factory()()
+        try:
+            yield session
+        finally:
+            session.close()
+
+    @contextmanager
+    def _write_session(self):
+        """
+        Provide a session for a write on the writer connection, holding the write lock if there is one until the
+        session is closed.
+        """
+        if self._write_lock:
+            self._write_lock.acquire()
+        session = self.write_session_factory()
+        try:
+            yield session
+        finally:
+            session.close()
+            if self._write_lock:
+                self._write_lock.release()
+
+    def _track_existing_open_runs(self):
+        """
+        Populate the open runs table from runs stored as IN_PROGRESS before it existed.
+        """
+        existing = select([PipelineRun.id, PipelineRun.source, PipelineRun.run_id, PipelineRun.project,
+                           PipelineRun.repository, PipelineRun.branch]).where(PipelineRun.status == IN_PROGRESS)
+        with self._write_session() as session:
+            session.execute(OpenRun.__table__.insert().from_select(
+                    ['id', 'source', 'run_id', 'project', 'repository', 'branch'], existing))
+            self._bump_data_version(session)
+            session.commit()
 
     def check_project_exists(self, project):
         """
@@ -37,9 +261,8 @@ class PipelineResults(object):
         :param project: project key as string
         :return: status as boolean
         """
-        session = self.session_factory()
-        exists = session.query(PipelineRun).filter_by(project=project).first()
-        session.close()
+        with self._read_session() as session:
+            exists = session.query(PipelineRun).filter_by(project=project).first()
         if exists:
             return True
         return False
@@ -50,37 +273,396 @@ class PipelineResults(object):
         :param kwargs: key and value to filter by, e.g. _get_filtered_results(id=1, success=True)
         :return: list of results
         """
-        session = self.session_factory()
-        results = list(session.query(PipelineRun).filter_by(**kwargs).all())
-        session.close()
+        with self._read_session() as session:
+            results = list(session.query(PipelineRun).filter_by(**kwargs).all())
         return results
 
+    @staticmethod
+    def _load_only(query, fields):
+        """
+        Restrict a query for PipelineRun rows to the given columns, so the rest are never read from the database.
+        The primary key is always loaded.
+        :param query: Query for PipelineRun
+        :param fields: list of column names, or None to load every column
+        :return: Query
+        """
+        if not fields:
+            return query
+        return query.options(load_only(*[getattr(PipelineRun, field) for field in fields]))
+
     def insert_single_result(self, result):
         """
         Add new unique result to database
         :param result: result from djinn.djenkins.DJenkins as dict
+        :return: dict of counts of rows inserted, updated and skipped
         """
-        session = self.session_factory()
-        if not self._check_row_exists(pk=result.get('id')):
-            session.add(PipelineRun(**result))
-        if self._get_filtered_results(id=result.get('id'), status='IN_PROGRESS'):
-            session.query(PipelineRun).filter_by(id=result.get('id')).update(result)
-        session.commit()
-        session.close()
+        return self.insert_result_batch([result])
 
     def insert_result_batch(self, results):
         """
-        Add a list of results to database
+        Add a list of results to database. New results are inserted, results already stored as IN_PROGRESS are
+        updated and anything else already stored is skipped. Existing rows are resolved with chunked IN queries,
+        locked until the batch commits, and written with multi-row statements, so a batch costs a handful of round
+        trips rather than several per row.
         :param results: list of results from djinn.djenkins.DJenkins
+        :return: dict of counts of rows inserted, updated and skipped
         """
-        session = self.session_factory()
+        results = list(results)
+        columns = [column.name for column in PipelineRun.__table__.columns]
+        rows = OrderedDict()
         for result in results:
-            if not self._check_row_exists(pk=result.get('id')):
-                session.add(PipelineRun(**result))
-            if self._get_filtered_results(id=result.get('id'), status='IN_PROGRESS'):
-                session.query(PipelineRun).filter_by(id=result.get('id')).update(result)
+            row = dict((column, result.get(column)) for column in columns)
+            # Jenkins reports run IDs as strings, store them as integers so they sort and compare numerically.
+            for column in ('run_id', 'timestamp'):
+                if row[column] is not None:
+                    row[column] = int(row[column])
+            rows[result.get('id')] = row
+        with self._write_session() as session:
+            stored = dict()
+            for chunk in chunked(list(rows.keys()), IN_QUERY_CHUNK_SIZE):
+                query = session.query(PipelineRun.id, PipelineRun.status, PipelineRun.success, PipelineRun.project,
+                                      PipelineRun.repository, PipelineRun.stage_failed, PipelineRun.timestamp)
+                # Lock the stored rows until we commit, so a concurrent writer resolving the same IN_PROGRESS run
+                # waits and then sees it finished, rather than applying its failure count deltas a second time.
+                # SQLite has no row locks and drops the clause, but its writes are already serialized.
+                query = query.filter(PipelineRun.id.in_(chunk)).with_for_update()
+                for row in query.all():
+                    stored[row.id] = row
+            inserts = [row for pk, row in rows.items() if pk not in stored]
+            updates = [row for pk, row in rows.items() if pk in stored and stored[pk].status == IN_PROGRESS]
+            self._write_rows(session, inserts, updates)
+            self._update_open_runs(session, inserts, updates)
+            self._update_latest_runs(session, list(rows.values()))
+            self._update_failure_counts(session, added=inserts + updates,
+                                        removed=[stored[row['id']] for row in updates])
+            if inserts or updates:
+                self._bump_data_version(session)
+            session.commit()
+        skipped = len(results) - len(inserts) - len(updates)
+        return {'inserted': len(inserts), 'updated': len(updates), 'skipped': skipped}
+
+    @staticmethod
+    def _write_rows(session, inserts, updates):
+        """
+        Insert new rows and overwrite rows stored as IN_PROGRESS, using the dialect's native upsert if it has one
+        so rows inserted by a concurrent writer since they were resolved don't cause an integrity error.
+        :param session: session the batch is being written in
+        :param inserts: list of row dicts not yet stored
+        :param updates: list of row dicts currently stored as IN_PROGRESS
+        """
+        table = PipelineRun.__table__
+        dialect = session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            stmt = sqlite.insert(table)
+            stmt = stmt.on_conflict_do_update(
+                    index_elements=[table.c.id], where=table.c.status == IN_PROGRESS,
+                    set_=dict((column.name, stmt.excluded[column.name]) for column in table.columns
+                              if not column.primary_key))
+        elif dialect == 'mysql':
+            stmt = mysql.insert(table)
+            # MySQL applies assignments left to right, so status must be overwritten last for the checks to work.
+            assignments = [(column.name, func.IF(table.c.status == IN_PROGRESS, stmt.inserted[column.name], column))
+                           for column in table.columns if not column.primary_key and column.name != 'status']
+            assignments.append(('status', func.IF(table.c.status == IN_PROGRESS, stmt.inserted.status, table.c.status)))
+            stmt = stmt.on_duplicate_key_update(assignments)
+        else:
+            stmt = None
+        if stmt is None:
+            for chunk in chunked(inserts, INSERT_CHUNK_SIZE):
+                session.execute(table.insert().values(chunk))
+            for row in updates:
+                session.execute(table.update().where(table.c.id == row['id']).values(row))
+            return
+        for chunk in chunked(inserts + updates, INSERT_CHUNK_SIZE):
+            session.execute(stmt.values(chunk))
+
+    @staticmethod
+    def _update_failure_counts(session, added, removed):
+        """
+        Adjust the failure counts rollup for runs written in a batch, in the same transaction as the runs themselves.
+        :param session: session the batch is being written in
+        :param added: list of row dicts written in this batch
+        :param removed: list of rows overwritten in this batch, as previously stored
+        """
+        deltas = dict()
+        for rows, delta in ((added, 1), (removed, -1)):
+            for row in rows:
+                row = row if isinstance(row, dict) else row._asdict()
+                if row['success'] is not False:
+                    continue
+                key = (row['project'], row['repository'], row['stage_failed'] or NO_STAGE,
+                       (row['timestamp'] or 0) // MS_PER_DAY)
+                deltas[key] = deltas.get(key, 0) + delta
+        counts = [dict(project=project, repository=repository, stage_failed=stage_failed, day=day, failures=failures)
+                  for (project, repository, stage_failed, day), failures in deltas.items() if failures]
+        if not counts:
+            return
+        table = FailureCount.__table__
+        dialect = session.get_bind().dialect.name
+        if dialect == 'sqlite':
+            stmt = sqlite.insert(table)
+            stmt = stmt.on_conflict_do_update(index_elements=[column for column in table.primary_key],
+                                              set_={'failures': table.c.failures + stmt.excluded.failures})
+        elif dialect == 'mysql':
+            stmt = mysql.insert(table)
+            stmt = stmt.on_duplicate_key_update(failures=table.c.failures + stmt.inserted.failures)
+        else:
+            for count in counts:
+                key = [column == count[column.name] for column in table.primary_key]
+                updated = session.execute(table.update().where(and_(*key)).values(
+                        failures=table.c.failures + count['failures']))
+                if not updated.rowcount:
+                    session.execute(table.insert().values(count))
+            return
+        for chunk in chunked(counts, INSERT_CHUNK_SIZE):
+            session.execute(stmt.values(chunk))
+
+    def rebuild_failure_counts(self):
+        """
+        Recount every failed run into the failure counts rollup, e.g. to repair the failure_counts table.
+        """
+        # Subtract the remainder before dividing, so MySQL's decimal division still gives a whole day.
+        day = cast((func.coalesce(PipelineRun.timestamp, 0) - func.coalesce(PipelineRun.timestamp, 0) % MS_PER_DAY) /
+                   MS_PER_DAY, Integer).label('day')
+        stage_failed = func.coalesce(PipelineRun.stage_failed, NO_STAGE).label('stage_failed')
+        counts = select([PipelineRun.project, PipelineRun.repository, stage_failed, day, func.count()]).where(
+                PipelineRun.success.is_(False)).group_by(PipelineRun.project, PipelineRun.repository, stage_failed, day)
+        with self._write_session() as session:
+            session.query(FailureCount).delete()
+            session.execute(FailureCount.__table__.insert().from_select(
+                    ['project', 'repository', 'stage_failed', 'day', 'failures'], counts))
+            self._bump_data_version(session)
+            session.commit()
+
+    @staticmethod
+    def _update_open_runs(session, inserts, updates):
+        """
+        Start tracking newly stored IN_PROGRESS runs and stop tracking runs which have since finished.
+        :param session: session the batch is being written in
+        :param inserts: list of row dicts inserted in this batch
+        :param updates: list of row dicts updated in this batch
+        """
+        opened = [dict(id=row['id'], source=row['source'], run_id=row['run_id'], project=row['project'],
+                       repository=row['repository'], branch=row['branch'])
+                  for row in inserts if row['status'] == IN_PROGRESS]
+        if opened:
+            session.execute(OpenRun.__table__.insert(), opened)
+        closed = [row['id'] for row in updates if row['status'] != IN_PROGRESS]
+        for chunk in chunked(closed, IN_QUERY_CHUNK_SIZE):
+            session.query(OpenRun).filter(OpenRun.id.in_(chunk)).delete(synchronize_session=False)
+
+    @staticmethod
+    def _update_latest_runs(session, rows):
+        """
+        Point each repository branch in a batch at its newest run, if that's newer than the run already recorded.
+        :param session: session the batch is being written in
+        :param rows: list of row dicts being written
+        """
+        newest = dict()
+        for row in rows:
+            key = (row['source'] or NO_SOURCE, row['project'], row['repository'], row['branch'] or NO_BRANCH)
+            if key not in newest or newest[key]['run_id'] < row['run_id']:
+                newest[key] = row
+        if not newest:
+            return
+        latest = dict()
+        # each key binds four parameters, so keep the chunks within the same parameter budget as the IN lookups
+        for chunk in chunked(list(newest.keys()), IN_QUERY_CHUNK_SIZE // 4):
+            keys = or_(*[and_(LatestRun.source == source, LatestRun.project == project,
+                              LatestRun.repository == repository, LatestRun.branch == branch)
+                         for source, project, repository, branch in chunk])
+            latest.update(((run.source, run.project, run.repository, run.branch), run)
+                          for run in session.query(LatestRun).filter(keys))
+        for (source, project, repository, branch), row in newest.items():
+            run = latest.get((source, project, repository, branch))
+            if run is None:
+                session.add(LatestRun(source=source, project=project, repository=repository, branch=branch,
+                                      run_id=row['run_id'], result_id=row['id']))
+            elif run.run_id < row['run_id']:
+                run.run_id = row['run_id']
+                run.result_id = row['id']
+
+    def rebuild_latest_runs(self):
+        """
+        Recalculate the latest run for every repository branch from the full history, e.g. to repair the latest_runs
+        table.
+        """
+        source = func.coalesce(PipelineRun.source, NO_SOURCE)
+        branch = func.coalesce(PipelineRun.branch, NO_BRANCH)
+        highest = select([source.label('source'), PipelineRun.project, PipelineRun.repository, branch.label('branch'),
+                          func.max(PipelineRun.run_id).label('run_id')]).group_by(
+                source, PipelineRun.project, PipelineRun.repository, branch).alias('highest')
+        latest = select([source, PipelineRun.project, PipelineRun.repository, branch, PipelineRun.run_id,
+                         PipelineRun.id]).where(
+                (source == highest.c.source) & (PipelineRun.project == highest.c.project) &
+                (PipelineRun.repository == highest.c.repository) & (branch == highest.c.branch) &
+                (PipelineRun.run_id == highest.c.run_id))
+        with self._write_session() as session:
+            session.query(LatestRun).delete()
+            session.execute(LatestRun.__table__.insert().from_select(
+                    ['source', 'project', 'repository', 'branch', 'run_id', 'result_id'], latest))
+            self._bump_data_version(session)
+            session.commit()
+
+    def get_high_water_marks(self, source=None):
+        """
+        Return the highest run ID stored for each branch of each repository of a Jenkins source. Runs stored before
+        branches were recorded are under an empty branch name.
+        :param source: name of the Jenkins source, or None for the unnamed source.
+        :return: dict of {(project, repository, branch): run ID as int}
+        """
+        with self._read_session() as session:
+            query = session.query(LatestRun).filter(LatestRun.source == (source or NO_SOURCE))
+            results = {(row.project, row.repository, row.branch): row.run_id for row in query.all()}
+        return results
+
+    def adopt_legacy_runs(self, branch):
+        """
+        Assign runs stored before branches were recorded to the branch they were crawled from, giving them the IDs
+        they'd get if crawled now, so they aren't fetched again as new runs. Does nothing once every run has a branch.
+        :param branch: branch name the runs were crawled from, i.e. the pipeline branch previously configured
+        :return: number of runs adopted
+        """
+        legacy = PipelineRun.branch.is_(None)
+        run_id = cast(PipelineRun.run_id, String(length=255))
+        with self._write_session() as session:
+            adopted = session.query(PipelineRun).filter(legacy).update(
+                    {'id': PipelineRun.repository + '/' + branch + '/' + run_id, 'branch': branch},
+                    synchronize_session=False)
+            if adopted:
+                # The derived tables point at the old IDs, so rebuild them.
+                session.query(OpenRun).delete()
+            session.commit()
+        if adopted:
+            self._track_existing_open_runs()
+            self.rebuild_latest_runs()
+        return adopted
+
+    def get_open_runs(self):
+        """
+        Return runs stored while still in progress, which need refreshing until they finish.
+        :return: list of OpenRun rows
+        """
+        with self._read_session() as session:
+            results = session.query(OpenRun).all()
+        return results
+
+    def remove_open_runs(self, ids):
+        """
+        Stop tracking runs as in progress without a final result, e.g. because they no longer exist in Jenkins. The
+        runs themselves are kept as last stored.
+        :param ids: list of result IDs
+        :return: number of runs no longer tracked
+        """
+        if not ids:
+            return 0
+        removed = 0
+        with self._write_session() as session:
+            for chunk in chunked(list(ids), IN_QUERY_CHUNK_SIZE):
+                removed += session.query(OpenRun).filter(OpenRun.id.in_(chunk)).delete(synchronize_session=False)
+            session.commit()
+        return removed
+
+    def register_crawler(self, owner, ttl, now=None):
+        """
+        Record that a crawler instance is running for the next ttl seconds, and count the instances running, so each
+        can take its share of the crawl leases. Registrations which have expired are removed.
+        Expiry is judged by each instance's own clock, so clocks should agree to well within ttl.
+        :param owner: unique name of the crawler instance
+        :param ttl: seconds the registration lasts unless renewed
+        :param now: current time in seconds, or None to use the clock
+        :return: number of crawler instances running, including this one
+        """
+        now = int((time.time() if now is None else now) * 1000)
+        expires = now + int(ttl * 1000)
+        with self._write_session() as session:
+            session.query(Crawler).filter(Crawler.expires <= now).delete(synchronize_session=False)
+            if not session.query(Crawler).filter_by(owner=owner).update({'expires': expires},
+                                                                       synchronize_session=False):
+                session.add(Crawler(owner=owner, expires=expires))
+            session.commit()
+            count = session.query(func.count(Crawler.owner)).scalar()
+        return count
+
+    def acquire_leases(self, owner, folders, ttl, limit=None, now=None):
+        """
+        Renew the leases an instance holds on project folders and take leases on folders which are free or whose
+        lease has expired, up to a limit. Leases held beyond the limit, or on folders no longer given, are released
+        so other instances can take them. Each lease is claimed with a single conditional statement, so two
+        instances can never hold the same folder.
+        :param owner: unique name of the crawler instance
+        :param folders: list of every project folder to crawl
+        :param ttl: seconds the leases last unless renewed
+        :param limit: most folders to hold, or None for no limit
+        :param now: current time in seconds, or None to use the clock
+        :return: list of folders leased to this instance
+        """
+        now = int((time.time() if now is None else now) * 1000)
+        expires = now + int(ttl * 1000)
+        held = list()
+        with self._write_session() as session:
+            current = [row.folder for row in session.query(CrawlLease.folder).filter_by(owner=owner)
+                       .order_by(CrawlLease.folder)]
+            # Renew what we already hold first, so leases only change hands when the number of instances does.
+            candidates = [folder for folder in current if folder in folders]
+            candidates += [folder for folder in folders if folder not in current]
+            for folder in candidates:
+                if limit is not None and len(held) >= limit:
+                    break
+                if self._claim_lease(session, folder, owner, now, expires):
+                    held.append(folder)
+            released = [folder for folder in current if folder not in held]
+            if released:
+                session.query(CrawlLease).filter(CrawlLease.owner == owner, CrawlLease.folder.in_(released)).delete(
+                        synchronize_session=False)
+                session.commit()
+        return held
+
+    @staticmethod
+    def _claim_lease(session, folder, owner, now, expires):
+        """
+        Take or renew the lease on a folder if it's free, expired or already ours, committing immediately.
+        :param session: Session bound to the target database
+        :param folder: project folder name
+        :param owner: unique name of the crawler instance
+        :param now: current time in epoch milliseconds
+        :param expires: new expiry time in epoch milliseconds
+        :return: True if the lease is now held by owner
+        """
+        claimed = session.query(CrawlLease).filter(
+                CrawlLease.folder == folder, or_(CrawlLease.owner == owner, CrawlLease.expires <= now)).update(
+                {'owner': owner, 'expires': expires}, synchronize_session=False)
         session.commit()
-        session.close()
+        if claimed:
+            return True
+        # Either nobody has leased the folder yet or someone else holds it; the primary key settles which.
+        try:
+            session.execute(CrawlLease.__table__.insert().values(folder=folder, owner=owner, expires=expires))
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            return False
+        return True
+
+    def release_leases(self, owner):
+        """
+        Give up every lease an instance holds and remove its registration, e.g. on shutdown, so other instances
+        can take over its folders without waiting for the leases to expire.
+        :param owner: unique name of the crawler instance
+        """
+        with self._write_session() as session:
+            session.query(CrawlLease).filter_by(owner=owner).delete(synchronize_session=False)
+            session.query(Crawler).filter_by(owner=owner).delete(synchronize_session=False)
+            session.commit()
+
+    def get_leases(self):
+        """
+        Return every crawl lease, including expired ones.
+        :return: dict of {folder: (owner, expiry time in epoch milliseconds)}
+        """
+        with self._read_session() as session:
+            results = {row.folder: (row.owner, row.expires) for row in session.query(CrawlLease).all()}
+        return results
 
     def get_result_by_primary_key(self, pk):
         """
@@ -88,23 +670,22 @@ class PipelineResults(object):
         :param pk: primary key to retrieve
         :return: PipelineRun or None
         """
-        session = self.session_factory()
-        result = session.query(PipelineRun).filter_by(id=pk).first()
-        session.close()
+        with self._read_session() as session:
+            result = session.query(PipelineRun).filter_by(id=pk).first()
         return result
 
-    def get_all_results(self, timestamp=None):
+    def get_all_results(self, timestamp=None, fields=None):
         """
         Get all results, optionally before a certain epoch time.
-        :param timestamp: epoch millseconds as string, or None
+        :param timestamp: epoch milliseconds as int, or None
+        :param fields: only load these columns if given, as a list of names
         :return: list of PipelineRun rows
         """
-        session = self.session_factory()
-        query = session.query(PipelineRun)
-        if timestamp:
-            query = query.filter(PipelineRun.timestamp <= timestamp)
-        results = query.all()
-        session.close()
+        with self._read_session() as session:
+            query = self._load_only(session.query(PipelineRun), fields)
+            if timestamp:
+                query = query.filter(PipelineRun.timestamp <= timestamp)
+            results = query.all()
         return results
 
     def get_all_failures(self):
@@ -114,34 +695,237 @@ class PipelineResults(object):
         """
         return self._get_filtered_results(success=False)
 
-    def get_results_for_project(self, project, timestamp=None):
+    def get_results_for_project(self, project, timestamp=None, fields=None):
         """
         Get all results for a given project, optionally before a certain epoch time.
         :param project: project name as string
-        :param timestamp: epoch milliseconds as string, or None
+        :param timestamp: epoch milliseconds as int, or None
+        :param fields: only load these columns if given, as a list of names
         :return: list of PipelineRun rows
         """
-        session = self.session_factory()
-        query = session.query(PipelineRun).filter(PipelineRun.project == project)
-        if timestamp:
-            query = query.filter(PipelineRun.timestamp <= timestamp)
-        results = query.all()
-        session.close()
+        with self._read_session() as session:
+            query = self._load_only(session.query(PipelineRun), fields).filter(PipelineRun.project == project)
+            if timestamp:
+                query = query.filter(PipelineRun.timestamp <= timestamp)
+            results = query.all()
         return results
 
-    def get_results_for_repo(self, reponame, timestamp=None):
+    def get_results_for_repo(self, reponame, timestamp=None, fields=None):
         """
         Get all results for a given repository, optionally before a certain epoch time.
         :param reponame: repository as string
-        :param timestamp: epoch milliseconds as string, or None
+        :param timestamp: epoch milliseconds as int, or None
+        :param fields: only load these columns if given, as a list of names
         :return: list of PipelineRun rows
         """
-        session = self.session_factory()
-        query = session.query(PipelineRun).filter(PipelineRun.repository == reponame)
+        with self._read_session() as session:
+            query = self._load_only(session.query(PipelineRun), fields).filter(PipelineRun.repository == reponame)
+            if timestamp:
+                query = query.filter(PipelineRun.timestamp <= timestamp)
+            results = query.all()
+        return results
+
+    def get_results_page(self, limit, after=None, project=None, reponame=None, timestamp=None, fields=None,
+                         branch=None, source=None):
+        """
+        Get one page of results, newest first, using keyset pagination on (timestamp, id) so that every page costs
+        the same however deep it is. Runs without a timestamp can't be ordered and are left out.
+        :param limit: maximum number of results to return as int
+        :param after: (timestamp, id) of the last result on the previous page, or None for the first page
+        :param project: only return results for this project if given
+        :param reponame: only return results for this repository if given
+        :param timestamp: only return results before this epoch milliseconds time if given
+        :param fields: only load these columns if given, as a list of names
+        :param branch: only return results for this branch if given
+        :param source: only return results from this Jenkins source if given
+        :return: tuple of (list of PipelineRun rows, (timestamp, id) to fetch the next page after or None)
+        """
+        if fields and 'timestamp' not in fields:
+            # The next page's key is read from the last row, so its timestamp is needed even if not requested.
+            fields = list(fields) + ['timestamp']
+        with self._read_session() as session:
+            query = self._filter_results(self._load_only(session.query(PipelineRun), fields), project=project,
+                                         reponame=reponame, timestamp=timestamp, branch=branch, source=source)
+            results = self._filter_page(query, limit, after).all()
+        return self._split_page(results, limit)
+
+    def iter_results(self, project=None, reponame=None, timestamp=None, fields=None, batch_size=1000, branch=None,
+                     source=None):
+        """
+        Lazily get results, reading them from a server-side cursor in batches so that memory use doesn't grow with
+        the number of results. The session stays open until the generator is exhausted or closed.
+        :param project: only return results for this project if given
+        :param reponame: only return results for this repository if given
+        :param timestamp: only return results before this epoch milliseconds time if given
+        :param fields: only load these columns if given, as a list of names
+        :param batch_size: number of rows to fetch from the cursor at a time
+        :param branch: only return results for this branch if given
+        :param source: only return results from this Jenkins source if given
+        :return: generator of PipelineRun rows
+        """
+        session = self._read_session_factory()()
+        try:
+            query = self._filter_results(self._load_only(session.query(PipelineRun), fields), project=project,
+                                         reponame=reponame, timestamp=timestamp, branch=branch, source=source)
+            for result in query.execution_options(stream_results=True).yield_per(batch_size):
+                yield result
+        finally:
+            session.close()
+
+    @staticmethod
+    def _filter_results(query, project=None, reponame=None, timestamp=None, branch=None, source=None):
+        """
+        Apply the filters shared by the results getters to an ORM query or a Core select.
+        :param query: Query for PipelineRun, or select from pipeline_runs
+        :param project: only return results for this project if given
+        :param reponame: only return results for this repository if given
+        :param timestamp: only return results before this epoch milliseconds time if given
+        :param branch: only return results for this branch if given
+        :param source: only return results from this Jenkins source if given
+        :return: filtered query or select
+        """
+        if project:
+            query = query.filter(PipelineRun.project == project)
+        if reponame:
+            query = query.filter(PipelineRun.repository == reponame)
+        if branch:
+            query = query.filter(PipelineRun.branch == branch)
+        if source:
+            query = query.filter(PipelineRun.source == source)
         if timestamp:
             query = query.filter(PipelineRun.timestamp <= timestamp)
-        results = query.all()
-        session.close()
+        return query
+
+    @staticmethod
+    def _filter_page(query, limit, after=None):
+        """
+        Restrict an ORM query or a Core select to the page of results after a (timestamp, id) key, newest first.
+        One extra row is fetched to find out whether there's another page without a separate count. Apply any other
+        filters first, since queries can't be filtered once limited.
+        :param query: Query for PipelineRun, or select from pipeline_runs
+        :param limit: maximum number of results on the page as int
+        :param after: (timestamp, id) of the last result on the previous page, or None for the first page
+        :return: ordered and limited query or select
+        """
+        query = query.filter(PipelineRun.timestamp.isnot(None))
+        if after:
+            last_timestamp, last_id = after
+            query = query.filter(or_(PipelineRun.timestamp < last_timestamp,
+                                     and_(PipelineRun.timestamp == last_timestamp, PipelineRun.id < last_id)))
+        return query.order_by(PipelineRun.timestamp.desc(), PipelineRun.id.desc()).limit(limit + 1)
+
+    @staticmethod
+    def _split_page(results, limit):
+        """
+        Trim the extra row fetched by _filter_page and work out the key of the next page.
+        :param results: list of rows fetched with _filter_page
+        :param limit: maximum number of results on the page as int
+        :return: tuple of (list of rows, (timestamp, id) to fetch the next page after or None)
+        """
+        if len(results) <= limit:
+            return results, None
+        results = results[:limit]
+        return results, (results[-1].timestamp, results[-1].id)
+
+    @staticmethod
+    def _select_columns(fields=None):
+        """
+        Build a Core select of pipeline_runs columns, for the read methods returning plain rows.
+        :param fields: only select these columns and the ID if given, as a list of names
+        :return: select
+        """
+        table = PipelineRun.__table__
+        if not fields:
+            return select([table])
+        return select([table.c.id] + [table.c[field] for field in fields if field != 'id'])
+
+    def get_result_rows(self, project=None, reponame=None, timestamp=None, fields=None, branch=None, source=None):
+        """
+        Get results as plain rows rather than ORM instances, avoiding object construction and identity map
+        bookkeeping for large reads. Rows support attribute access and _asdict().
+        :param project: only return results for this project if given
+        :param reponame: only return results for this repository if given
+        :param timestamp: only return results before this epoch milliseconds time if given
+        :param fields: only select these columns and the ID if given, as a list of names
+        :param branch: only return results for this branch if given
+        :param source: only return results from this Jenkins source if given
+        :return: list of rows
+        """
+        query = self._filter_results(self._select_columns(fields), project=project, reponame=reponame,
+                                     timestamp=timestamp, branch=branch, source=source)
+        with self._read_session() as session:
+            results = session.execute(query).fetchall()
+        return results
+
+    def get_latest_result_rows(self, project=None, fields=None, branch=None, source=None):
+        """
+        Get the result for the highest run ID of each branch of each repository as plain rows.
+        :param project: only return results for this project if given
+        :param fields: only select these columns and the ID if given, as a list of names
+        :param branch: only return results for this branch if given
+        :param source: only return results from this Jenkins source if given
+        :return: list of rows
+        """
+        query = self._select_columns(fields).select_from(PipelineRun.__table__.join(
+                LatestRun.__table__, LatestRun.result_id == PipelineRun.id))
+        if project:
+            query = query.where(LatestRun.project == project)
+        if branch:
+            query = query.where(LatestRun.branch == branch)
+        if source:
+            query = query.where(LatestRun.source == source)
+        with self._read_session() as session:
+            results = session.execute(query).fetchall()
+        return results
+
+    def get_result_rows_page(self, limit, after=None, project=None, reponame=None, timestamp=None, fields=None,
+                             branch=None, source=None):
+        """
+        Get one page of results as plain rows, newest first. Takes the same arguments as get_results_page.
+        :return: tuple of (list of rows, (timestamp, id) to fetch the next page after or None)
+        """
+        if fields and 'timestamp' not in fields:
+            fields = list(fields) + ['timestamp']
+        query = self._filter_results(self._select_columns(fields), project=project, reponame=reponame,
+                                     timestamp=timestamp, branch=branch, source=source)
+        query = self._filter_page(query, limit, after)
+        with self._read_session() as session:
+            results = session.execute(query).fetchall()
+        return self._split_page(results, limit)
+
+    def iter_result_rows(self, project=None, reponame=None, timestamp=None, fields=None, batch_size=1000,
+                         branch=None, source=None):
+        """
+        Lazily get results as plain rows from a server-side cursor. Takes the same arguments as iter_results.
+        :return: generator of rows
+        """
+        query = self._filter_results(self._select_columns(fields), project=project, reponame=reponame,
+                                     timestamp=timestamp, branch=branch, source=source)
+        session = self._read_session_factory()()
+        try:
+            results = session.execute(query.execution_options(stream_results=True))
+            for rows in iter(lambda: results.fetchmany(batch_size), []):
+                for row in rows:
+                    yield row
+        finally:
+            session.close()
+
+    def get_failure_counts(self, group_by='project', project=None):
+        """
+        Count failed runs for each stage and project or repository, read from the failure counts rollup rather
+        than the runs themselves.
+        :param group_by: column to count failures for within each stage, 'project' or 'repository'
+        :param project: only count failures in this project if given
+        :return: list of (stage_failed, project or repository, failures) tuples
+        """
+        key = getattr(FailureCount, group_by)
+        failures = func.sum(FailureCount.failures)
+        with self._read_session() as session:
+            query = session.query(FailureCount.stage_failed, key, failures)
+            if project:
+                query = query.filter(FailureCount.project == project)
+            query = query.group_by(FailureCount.stage_failed, key).having(failures > 0)
+            results = [(stage or None, inner, int(count)) for stage, inner, count in query.all()]
         return results
 
     def get_failed_results_for_project(self, projectname):
@@ -181,9 +965,8 @@ class PipelineResults(object):
         Return list of project names available.
         :return: List of strings
         """
-        session = self.session_factory()
-        results = [row.project for row in session.query(PipelineRun.project.distinct().label('project')).all()]
-        session.close()
+        with self._read_session() as session:
+            results = [row.project for row in session.query(PipelineRun.project.distinct().label('project')).all()]
         return results
 
     def get_repos_for_project(self, project):
@@ -192,39 +975,31 @@ class PipelineResults(object):
         :param project: project name as string
         :return: list of strings
         """
-        session = self.session_factory()
-        results = [row.repo for row in
-                   session.query(PipelineRun.repository.distinct().label('repo')).filter_by(project=project).all()]
-        session.close()
+        with self._read_session() as session:
+            results = [row.repo for row in
+                       session.query(PipelineRun.repository.distinct().label('repo')).filter_by(project=project).all()]
         return results
 
-    def get_latest_results(self):
+    def get_latest_results(self, fields=None):
         """
         Return results for highest run ID for each repository
+        :param fields: only load these columns if given, as a list of names
         :return: list of PipelineRun rows
         """
-        session = self.session_factory()
-        subq = session.query(
-                PipelineRun.repository, func.max(cast(PipelineRun.run_id, Integer)).label('max_run_id')).group_by(
-                PipelineRun.repository).subquery('subq')
-        results = session.query(PipelineRun).filter(
-                PipelineRun.repository == subq.c.repository,
-                PipelineRun.run_id == cast(subq.c.max_run_id, String)).all()
-        session.close()
+        with self._read_session() as session:
+            query = self._load_only(session.query(PipelineRun), fields)
+            results = query.join(LatestRun, LatestRun.result_id == PipelineRun.id).all()
         return results
 
-    def get_latest_results_for_project(self, project):
+    def get_latest_results_for_project(self, project, fields=None):
         """
         Return results for the highest run ID for each repository in a given project.
         :param project: project name as string
+        :param fields: only load these columns if given, as a list of names
         :return: list of PipelineRun rows
         """
-        session = self.session_factory()
-        subq = session.query(
-                PipelineRun.repository, func.max(cast(PipelineRun.run_id, Integer)).label('max_run_id')).group_by(
-                PipelineRun.repository).filter_by(project=project).subquery('subq')
-        results = session.query(PipelineRun).filter(
-                PipelineRun.repository == subq.c.repository,
-                PipelineRun.run_id == cast(subq.c.max_run_id, String)).all()
-        session.close()
+        with self._read_session() as session:
+            query = self._load_only(session.query(PipelineRun), fields)
+            results = query.join(LatestRun, LatestRun.result_id == PipelineRun.id).filter(
+                    LatestRun.project == project).all()
         return results
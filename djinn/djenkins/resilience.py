@@ -0,0 +1,122 @@
+import threading
+import time
+
+
+class JenkinsUnavailable(Exception):
+    """
+    Raised when Jenkins can't be reached or keeps failing, after retries, or straight away while the circuit breaker
+    is open.
+    """
+    pass
+
+
+class NotFound(Exception):
+    """
+    Raised for a 404 from Jenkins where the caller needs to know the job is gone, e.g. a run which was discarded or
+    whose branch or repository was deleted.
+    """
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        """
+        Token bucket rate limiter shared between threads. Tokens are added at a steady rate up to a maximum, and each
+        request takes one, waiting for it if the bucket is empty, so requests average out at the rate while short
+        bursts go through immediately.
+        :param rate: tokens added per second.
+        :param burst: most tokens the bucket holds, or None to allow bursts of one second's worth.
+        :param clock: function returning the current time in seconds, e.g. for testing.
+        :param sleep: function sleeping for a number of seconds, e.g. for testing.
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive, got {}'.format(rate))
+        self.rate = float(rate)
+        self.capacity = float(burst or max(rate, 1))
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        Take a token, going into debt if there are none so waiting threads queue up in order.
+        :return: seconds to wait before using the token
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        """
+        Wait until a request may be made.
+        :return: seconds waited
+        """
+        wait = self._reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+
+class CircuitBreaker(object):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, clock=time.time):
+        """
+        Stop sending requests to a service that is clearly down. After a number of consecutive failures the breaker
+        opens and requests are refused without being sent. Once the reset timeout has passed a single trial request
+        is let through: if it succeeds the breaker closes again, otherwise it stays open for another timeout.
+        :param failure_threshold: consecutive failures which open the breaker.
+        :param reset_timeout: seconds to stay open before letting a trial request through.
+        :param clock: function returning the current time in seconds, e.g. for testing.
+        """
+        if failure_threshold < 1:
+            raise ValueError('failure_threshold must be at least 1, got {}'.format(failure_threshold))
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Check whether a request may be sent, moving to half open if the breaker has been open long enough.
+        :return: True if the request may be sent
+        """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self.opened >= self.reset_timeout:
+                # Let this request through as the trial, and refuse the rest until it's done.
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        """
+        Record a request that succeeded, closing the breaker.
+        """
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """
+        Record a request that failed, opening the breaker if the trial failed or there have been too many failures.
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened = self.clock()
+                self.trips += 1
@@ -5,11 +5,39 @@ def get_epoch_time_of_weeks_ago(weeks):
     """
     Helper method to figure out epoch time for X weeks ago.
     :param weeks: number of weeks to subtract from current time as int.
-    :return: epoch millisecond timestamp as string, or None if weeks is None or zero.
+    :return: epoch millisecond timestamp as int, or None if weeks is None or zero.
     """
     if not weeks:
         return None
     weekms = 604800000  # Milliseconds in a week
     now = int(time.time() * 1000.0)
     timestamp = now - (weekms * weeks)
-    return str(timestamp)
+    return timestamp
+
+
+def chunked(items, size):
+    """
+    Split a list into consecutive chunks, e.g. to keep IN clauses and multi-row inserts to a sensible size.
+    :param items: list to split
+    :param size: maximum length of each chunk as int.
+    :return: generator of lists
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def chunked_iter(items, size):
+    """
+    Split any iterable into consecutive chunks without reading more than one chunk of it at a time.
+    :param items: iterable to split
+    :param size: maximum length of each chunk as int.
+    :return: generator of lists
+    """
+    chunk = list()
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
@@ -0,0 +1,341 @@
+import heapq
+import math
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from ..djenkins import DJenkins, JenkinsUnavailable
+from ..djinnutils.loggers import get_named_logger
+
+
+class PollScheduler(object):
+    def __init__(self, djinn, pipelinebranch='develop', workers=1, min_interval=300, max_interval=21600, jitter=0.1,
+                 discovery_interval=3600, lease_duration=None, owner=None, clock=time.time, rand=None, logger=None):
+        """
+        Poll each repository on its own interval, based on how often it has built recently, instead of crawling
+        every repository on a fixed timer. Busy repositories are polled often and dormant ones rarely, polls are
+        spread out with jitter rather than fired in bursts, and a repository is never polled again while a poll
+        of it is still running. Repositories on every one of the Djinn's Jenkins sources are polled from one schedule.
+        The first poll of a repository branch after each discovery skips fetching its history if its last build was
+        then the latest run already stored.
+        With lease_duration set, instances sharing a database split the crawl between them: each leases its share of
+        the project folders and only polls repositories in those, and an instance's folders are taken over by the
+        others if it stops renewing its leases, e.g. because it died.
+        :param djinn: Djinn instance to poll Jenkins and save results with
+        :param pipelinebranch: branch name or glob pattern used for pipelines, or a list of either. Each matching
+         branch of a repository is scheduled separately.
+        :param workers: number of repositories to poll concurrently.
+        :param min_interval: shortest time in seconds between polls of a repository.
+        :param max_interval: longest time in seconds between polls of a repository.
+        :param jitter: fraction by which each interval is randomly lengthened or shortened, between 0 and 1.
+        :param discovery_interval: time in seconds between checks for added and removed repositories.
+        :param lease_duration: time in seconds a lease on a project folder lasts unless renewed, or None to poll
+         every repository without coordinating with other instances. Leases are renewed every third of this.
+        :param owner: unique name of this instance for leases, or None to generate one.
+        :param clock: function returning the current time in seconds, e.g. for testing.
+        :param rand: random.Random instance, e.g. seeded for testing.
+        """
+        if workers < 1:
+            raise ValueError('workers must be at least 1, got {}'.format(workers))
+        if not 0 < min_interval <= max_interval:
+            raise ValueError('Expected 0 < min_interval <= max_interval, got {} and {}'.format(min_interval,
+                                                                                              max_interval))
+        self.djinn = djinn
+        self.pipelinebranch = pipelinebranch
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.discovery_interval = discovery_interval
+        self.lease_duration = lease_duration
+        self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.clock = clock
+        self.rand = rand or random.Random()
+        self.logger = logger or get_named_logger('PollScheduler')
+        # Heap of (due time, (source, project, repo, branch)). Entries whose due time no longer matches self.due are
+        # stale and skipped, which avoids searching the heap to reschedule.
+        self.queue = list()
+        self.due = dict()
+        self.intervals = dict()
+        self.in_flight = set()
+        self.polls = 0
+        self.failures = 0
+        self.skipped = 0
+        self.next_discovery = None
+        self.next_claim = None
+        # Repositories found by the last discovery, and the project folders leased to us, or None if not leasing.
+        self.found = set()
+        # Repositories which hadn't built since the latest run stored as of the last discovery, and haven't been
+        # polled since.
+        self.unchanged = set()
+        self.leased = set() if lease_duration else None
+        # When the leases held expire unless renewed, measured from before the claim renewing them was made.
+        self.leases_expire = None
+        self.pool = None
+        self.condition = threading.Condition()
+
+    def interval_for(self, timestamps):
+        """
+        Work out how often to poll a repository from the start times of its recent runs. It's polled about twice
+        per gap between builds, where the gap is the longer of the average gap between recent builds and the time
+        since the last one, so a repository that has gone quiet backs off.
+        :param timestamps: list of run start times in epoch milliseconds
+        :return: interval in seconds
+        """
+        timestamps = sorted(timestamp for timestamp in timestamps if timestamp)
+        if len(timestamps) < 2:
+            return self.max_interval
+        average_gap = (timestamps[-1] - timestamps[0]) / 1000.0 / (len(timestamps) - 1)
+        since_last = self.clock() - timestamps[-1] / 1000.0
+        return min(max(max(average_gap, since_last) / 2.0, self.min_interval), self.max_interval)
+
+    def _jittered(self, interval):
+        """
+        Randomly lengthen or shorten an interval by up to the jitter fraction.
+        :param interval: interval in seconds
+        :return: interval in seconds
+        """
+        return interval * self.rand.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _schedule(self, key, due):
+        """
+        Queue a repository to be polled at a given time. Call with the condition held.
+        :param key: (source, project, repo, branch) tuple
+        :param due: time to poll at, in seconds
+        """
+        self.due[key] = due
+        heapq.heappush(self.queue, (due, key))
+        self.condition.notify()
+
+    def discover(self):
+        """
+        Find repository branches matching the pipeline branch on each Jenkins source, then start polling any new ones
+        and stop polling any which have disappeared. A source which can't be reached keeps the repository branches
+        found last time. Branches whose last build is the latest run already stored, or which have never built, are
+        noted so their next poll can skip fetching. With leasing, leases are claimed for the folders found.
+        """
+        found = set()
+        unchanged = set()
+        for source, dj in self.djinn.sources.items():
+            try:
+                discovery = dj.discover_jobs()
+                high_water_marks = self.djinn.db.get_high_water_marks(source=source)
+            except Exception:
+                self.logger.exception('Error discovering repositories on {}'.format(source or 'Jenkins'))
+                found.update(key for key in self.found if key[0] == source)
+                continue
+            for folder, repos in discovery.items():
+                for repo, branches in repos.items():
+                    for branch in DJenkins.select_branches(branches, self.pipelinebranch):
+                        found.add((source, folder, repo, branch))
+                        lastbuild = branches[branch]
+                        if lastbuild is None or lastbuild == high_water_marks.get((folder, repo, branch)):
+                            unchanged.add((source, folder, repo, branch))
+        with self.condition:
+            self.found = found
+            self.unchanged = unchanged
+            self.next_discovery = self.clock() + self.discovery_interval
+        self.logger.info('Discovered {} repository branches'.format(len(found)))
+        if self.lease_duration:
+            self.claim()
+        else:
+            self._sync()
+
+    def claim(self):
+        """
+        Register this instance and renew its leases on project folders, taking its share of any which are free or
+        expired and releasing any beyond its share, so each of N instances ends up polling about 1/N of the folders.
+        """
+        folders = sorted(set(self._folder(key) for key in self.found))
+        started = self.clock()
+        crawlers = self.djinn.db.register_crawler(owner=self.owner, ttl=self.lease_duration, now=self.clock())
+        share = int(math.ceil(len(folders) / float(max(crawlers, 1))))
+        leased = self.djinn.db.acquire_leases(owner=self.owner, folders=folders, ttl=self.lease_duration,
+                                              limit=share, now=self.clock())
+        with self.condition:
+            self.leased = set(leased)
+            self.leases_expire = started + self.lease_duration
+            self.next_claim = self.clock() + self.lease_duration / 3.0
+        self.logger.info('Leased {} of {} folders, shared between {} instances'.format(len(leased), len(folders),
+                                                                                     crawlers))
+        self._sync()
+
+    def expire_leases(self):
+        """
+        Stop polling the folders of leases which couldn't be renewed in time, e.g. because the database was down, as
+        other instances may have taken them over. They're claimed again once renewal succeeds.
+        """
+        self.logger.warning('Leases on {} folders expired without being renewed, no longer polling them'.format(
+                len(self.leased)))
+        with self.condition:
+            self.leased = set()
+        self._sync()
+
+    def release(self):
+        """
+        Give up this instance's leases, e.g. on shutdown, so other instances take over its folders straight away.
+        """
+        if not self.lease_duration:
+            return
+        self.djinn.db.release_leases(owner=self.owner)
+        with self.condition:
+            self.leased = set()
+        self._sync()
+
+    @staticmethod
+    def _folder(key):
+        """
+        Name the project folder a repository branch is leased by, qualified by its source.
+        :param key: (source, project, repo, branch) tuple
+        :return: folder name
+        """
+        return DJenkins.qualified_folder(key[1], key[0])
+
+    def _sync(self):
+        """
+        Bring the schedule in line with the repository branches found and the folders leased. New ones have their
+        first polls spread across the minimum interval, and ones no longer ours are dropped.
+        """
+        now = self.clock()
+        with self.condition:
+            wanted = set(key for key in self.found if self.leased is None or self._folder(key) in self.leased)
+            added = 0
+            for key in wanted:
+                if key not in self.due and key not in self.in_flight:
+                    self._schedule(key, now + self.rand.uniform(0, self.min_interval))
+                    added += 1
+            removed = [key for key in self.due if key not in wanted]
+            for key in removed:
+                del self.due[key]
+                self.intervals.pop(key, None)
+        self.logger.info('Polling {} repository branches: {} added, {} removed'.format(len(wanted), added,
+                                                                                      len(removed)))
+
+    def poll(self, key):
+        """
+        Fetch a repository's history, save it and schedule its next poll based on how often it has built. If the last
+        discovery found it hadn't built since the latest run stored, the fetch is skipped and it's polled again at its
+        current interval, or the minimum interval if it has none yet so a restart doesn't leave busy repositories
+        waiting out the maximum.
+        :param key: (source, project, repo, branch) tuple
+        """
+        source, project, repo, branch = key
+        name = '/'.join(filter(None, key))
+        interval = self.intervals.get(key, self.max_interval)
+        delay = None
+        with self.condition:
+            unchanged = key in self.unchanged
+            self.unchanged.discard(key)
+        try:
+            if unchanged:
+                interval = self.intervals.get(key, self.min_interval)
+                with self.condition:
+                    self.skipped += 1
+            else:
+                history = self.djinn.sources[source].get_pipeline_history_for_repo(projectname=project,
+                                                                                  reponame=repo,
+                                                                                  pipelinebranch=branch)
+                if history:
+                    self.djinn.db.insert_result_batch(history)
+                interval = self.interval_for([run.get('timestamp') for run in history or list()])
+        except JenkinsUnavailable as err:
+            # Jenkins is down or restarting, so try again soon rather than waiting out a long interval.
+            self.logger.warning('Error polling {}: {}'.format(name, err))
+            delay = min(self.min_interval, interval)
+            with self.condition:
+                self.failures += 1
+        except Exception:
+            self.logger.exception('Error polling {}'.format(name))
+            with self.condition:
+                self.failures += 1
+        with self.condition:
+            self.polls += 1
+            self.in_flight.discard(key)
+            self.intervals[key] = interval
+            # The repository may have been removed by a discovery while it was being polled.
+            if key in self.due:
+                self._schedule(key, self.clock() + self._jittered(delay or interval))
+            # A worker is free, so anything overdue can be handed out.
+            self.condition.notify()
+
+    def _pop_due(self, now, limit=None):
+        """
+        Take repositories due to be polled off the queue and mark them in flight. Call with the condition held.
+        :param now: current time in seconds
+        :param limit: most repositories to take, or None for every one due
+        :return: list of (source, project, repo, branch) tuples
+        """
+        keys = list()
+        while self.queue and self.queue[0][0] <= now and (limit is None or len(keys) < limit):
+            due, key = heapq.heappop(self.queue)
+            if self.due.get(key) != due or key in self.in_flight:
+                continue
+            self.in_flight.add(key)
+            # Keep the key known while in flight, with no due time, so discovery doesn't schedule it again.
+            self.due[key] = None
+            keys.append(key)
+        return keys
+
+    def run_pending(self):
+        """
+        Hand repositories that are due to the worker pool, rediscovering repositories first if that's due. Only as
+        many are handed out as there are free workers, so the rest stay queued with their due times and are counted
+        by stats as waiting.
+        :return: number of polls started
+        """
+        try:
+            if self.next_discovery is None or self.clock() >= self.next_discovery:
+                self.discover()
+            elif self.lease_duration and self.clock() >= self.next_claim:
+                self.claim()
+        except Exception:
+            # Keep polling what we have, and retry on the next pass.
+            self.logger.exception('Error discovering repositories or claiming leases')
+        if self.leased and self.clock() >= self.leases_expire:
+            self.expire_leases()
+        if self.pool is None:
+            self.pool = ThreadPool(processes=self.workers)
+        with self.condition:
+            keys = self._pop_due(self.clock(), limit=self.workers - len(self.in_flight))
+        for key in keys:
+            self.pool.apply_async(self.poll, (key,))
+        return len(keys)
+
+    def run_forever(self, max_wait=60):
+        """
+        Poll repositories as they fall due, until the process exits.
+        :param max_wait: longest time in seconds to sleep between checks for due repositories.
+        """
+        while True:
+            self.run_pending()
+            with self.condition:
+                wait = max_wait
+                pending = [due for due, key in self.queue if self.due.get(key) == due]
+                # With every worker busy, wait to be notified that one is free rather than spinning on overdue polls.
+                if pending and len(self.in_flight) < self.workers:
+                    wait = min(max(min(pending) - self.clock(), 0), max_wait)
+                self.condition.wait(wait)
+
+    def stats(self):
+        """
+        Report how far behind the scheduler is, to size its worker pool.
+        :return: dict of the number of repositories scheduled, waiting for a worker (queue_depth) and being
+         polled (in_flight), how late in seconds the most overdue repository is (lag), the average polling
+         interval in seconds, counts of polls, failed polls and polls skipped as unchanged, the folders leased if
+         leasing, and DJenkins' request stats for the first Jenkins source and for each named source.
+        """
+        now = self.clock()
+        with self.condition:
+            overdue = [now - due for key, due in self.due.items() if due is not None and due <= now]
+            intervals = list(self.intervals.values())
+            return {'scheduled': len(self.due), 'queue_depth': len(overdue), 'in_flight': len(self.in_flight),
+                    'lag': max(overdue) if overdue else 0,
+                    'mean_interval': sum(intervals) / float(len(intervals)) if intervals else None,
+                    'polls': self.polls, 'failures': self.failures, 'skipped': self.skipped, 'owner': self.owner,
+                    'leased': sorted(self.leased) if self.leased is not None else None,
+                    'jenkins': self.djinn.dj.stats(),
+                    'sources': dict((source, dj.stats()) for source, dj in self.djinn.sources.items() if source)}
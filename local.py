@@ -1,12 +1,24 @@
-from djinn import Djinn
+from threading import Thread
+
+from djinn import Djinn, PollScheduler
 
 JENKINS_URL = 'https://replace:me@jenkinsurl'
+# Further Jenkins masters to crawl into the same database, e.g. {'emea': 'https://replace:me@emea-jenkinsurl'}.
+JENKINS_SOURCES = {}
 DB_URL = 'sqlite:///jenkins.db'
+# A branch name, a glob pattern such as 'release*', or a list of either.
 PIPELINE_BRANCH = 'develop'
+# The branch runs stored before branches were recorded were crawled from.
+LEGACY_BRANCH = 'develop'
 
-djinn = Djinn(jenkinsurl=JENKINS_URL, dburl=DB_URL)
-djinn.get_all_pipeline_results_and_save_to_db(pipelinebranch=PIPELINE_BRANCH)
-app = djinn.create_api()
+djinn = Djinn(jenkinsurl=JENKINS_URL, dburl=DB_URL, sources=JENKINS_SOURCES)
+djinn.db.adopt_legacy_runs(branch=LEGACY_BRANCH)
+# Repositories are polled in the background on adaptive intervals, while the API keeps serving what's already stored.
+scheduler = PollScheduler(djinn=djinn, pipelinebranch=PIPELINE_BRANCH)
+app = djinn.create_api(scheduler=scheduler)
+fetch = Thread(target=scheduler.run_forever)
+fetch.setDaemon(True)
+fetch.start()
 
 if __name__ == '__main__':
     from wsgiref import simple_server
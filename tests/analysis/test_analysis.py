@@ -1,10 +1,15 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
 from uuid import uuid4
 
 from hypothesis import given, settings
 from hypothesis.strategies import lists, integers, text, characters
 
-from djinn.analysis import gen_heatmap_with_strategy, projects_stage_inner_groupby
+from djinn.analysis import gen_heatmap_with_strategy, gen_heatmap_from_counts, projects_stage_inner_groupby, \
+    repos_stage_inner_groupby
+try:
+    from djinn.analysis.vectorized import vectorized_projects_strategy, vectorized_repos_strategy
+except ImportError:  # NumPy is optional
+    vectorized_projects_strategy = vectorized_repos_strategy = None
 
 """ Generate random upper case letter strings. """
 strings = text(characters(min_codepoint=66, max_codepoint=90)).map(lambda s: s.strip()).filter(
@@ -74,6 +79,49 @@ class TestAnalysisService(TestCase):
         actual_failures = build_failure_map(stages, projects, actual['z'])
         self.assertEqual(expected_failures, actual_failures)
 
+    @given(rectangle_lists)
+    @settings(max_examples=50)
+    def test_heatmap_from_counts_matches_heatmap_from_failures(self, given_z):
+        """
+        Given failure data, check that aggregating it to counts first produces exactly the same heatmap,
+        including the order of each axis.
+        :param given_z: the generated z value.
+        """
+        data, _, _, _ = gen_data_from_z(given_z)
+        for strategy, key in [(projects_stage_inner_groupby, 'project'), (repos_stage_inner_groupby, 'repository')]:
+            counts = dict()
+            for run in data:
+                count_key = (run.stage_failed, getattr(run, key))
+                counts[count_key] = counts.get(count_key, 0) + 1
+            expected = gen_heatmap_with_strategy(strategy, data)
+            actual = gen_heatmap_from_counts((stage, inner, failures) for (stage, inner), failures in counts.items())
+            self.assertEqual(expected['x'], actual['x'])
+            self.assertEqual(list(expected['y']), list(actual['y']))
+            self.assertEqual(expected['z'], actual['z'])
+
+    @skipIf(vectorized_projects_strategy is None, 'NumPy is not installed')
+    @given(rectangle_lists)
+    @settings(max_examples=50)
+    def test_vectorized_strategies_match_plain_strategies(self, given_z):
+        """
+        Given failure data, check the NumPy strategies produce exactly the same heatmap as the plain ones,
+        including the order of each axis.
+        :param given_z: the generated z value.
+        """
+        data, _, _, _ = gen_data_from_z(given_z)
+        for plain, vectorized in [(projects_stage_inner_groupby, vectorized_projects_strategy),
+                                  (repos_stage_inner_groupby, vectorized_repos_strategy)]:
+            expected = gen_heatmap_with_strategy(plain, data)
+            actual = gen_heatmap_with_strategy(vectorized, data)
+            self.assertEqual(expected['x'], actual['x'])
+            self.assertEqual(list(expected['y']), list(actual['y']))
+            self.assertEqual(expected['z'], actual['z'])
+
+    @skipIf(vectorized_projects_strategy is None, 'NumPy is not installed')
+    def test_vectorized_strategy_with_no_failures(self):
+        heatmap = gen_heatmap_with_strategy(vectorized_projects_strategy, [])
+        self.assertEqual({'x': [], 'y': [], 'z': []}, heatmap)
+
 
 class MockPipelineRun:
     def __init__(self, stage_failed, project, repository):
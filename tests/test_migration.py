@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect, text
+
+from djinn import PipelineResults
+
+LEGACY_SCHEMA = """
+CREATE TABLE pipeline_runs (
+    id VARCHAR(255) NOT NULL, run_id VARCHAR(255), project VARCHAR(255), repository VARCHAR(255),
+    status VARCHAR(255), timestamp VARCHAR(255), success BOOLEAN, stage_failed VARCHAR(255),
+    error_type VARCHAR(255), error_message VARCHAR(4096), PRIMARY KEY (id)
+)
+"""
+
+
+class TestMigration(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dburl = 'sqlite:///{}'.format(os.path.join(self.tempdir, 'legacy.db'))
+        engine = create_engine(self.dburl)
+        with engine.begin() as conn:
+            conn.execute(text(LEGACY_SCHEMA))
+            for run_id in ['9', '10', '11']:
+                conn.execute(text("INSERT INTO pipeline_runs (id, run_id, project, repository, status, timestamp, "
+                                  "success) VALUES (:id, :run_id, 'TEST', 'test-repo', :status, '1491143071036', 0)"),
+                             id='test-repo{}'.format(run_id), run_id=run_id,
+                             status='IN_PROGRESS' if run_id == '11' else 'FAILED')
+        engine.dispose()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_legacy_string_columns_are_converted_to_integers(self):
+        """
+        Check run IDs and timestamps stored as strings are converted, so they compare numerically.
+        """
+        db = PipelineResults(self.dburl)
+        latest = db.get_latest_results()
+        self.assertEqual(1, len(latest))
+        self.assertEqual(11, latest[0].run_id)
+        self.assertEqual(1491143071036, latest[0].timestamp)
+        self.assertEqual(3, len(db.get_all_results(timestamp=1491143071036)))
+        self.assertEqual([11], [run.run_id for run in db.get_open_runs()])
+
+    def test_missing_indexes_are_created(self):
+        """
+        Check indexes defined on our entities are added to an existing table, and migrating again is a no-op.
+        """
+        PipelineResults(self.dburl)
+        PipelineResults(self.dburl)
+        indexes = inspect(create_engine(self.dburl)).get_indexes('pipeline_runs')
+        self.assertItemsEqual([('ix_pipeline_runs_project_repository_run_id', ['project', 'repository', 'run_id']),
+                               ('ix_pipeline_runs_success_project', ['success', 'project']),
+                               ('ix_pipeline_runs_timestamp_id', ['timestamp', 'id']),
+                               ('ix_pipeline_runs_branch', ['branch']),
+                               ('ix_pipeline_runs_source', ['source'])],
+                              [(index['name'], index['column_names']) for index in indexes])
+
+    def test_obsolete_indexes_are_dropped(self):
+        """
+        Check indexes replaced by later versions are removed when migrating.
+        """
+        engine = create_engine(self.dburl)
+        with engine.begin() as conn:
+            conn.execute(text('CREATE INDEX ix_pipeline_runs_timestamp ON pipeline_runs (timestamp)'))
+        engine.dispose()
+        PipelineResults(self.dburl)
+        names = [index['name'] for index in inspect(create_engine(self.dburl)).get_indexes('pipeline_runs')]
+        self.assertNotIn('ix_pipeline_runs_timestamp', names)
+        self.assertIn('ix_pipeline_runs_timestamp_id', names)
+
+    def test_branch_columns_are_added(self):
+        """
+        Check a database from before branches and sources were recorded gains their columns, with latest_runs rebuilt
+        since its primary key changed, and its runs can then be adopted by a branch.
+        """
+        PipelineResults(self.dburl)
+        engine = create_engine(self.dburl)
+        with engine.begin() as conn:
+            conn.execute(text('CREATE TABLE pipeline_runs_copy AS SELECT id, run_id, project, repository, status, '
+                              'timestamp, success, stage_failed, error_type, error_message FROM pipeline_runs'))
+            conn.execute(text('DROP TABLE pipeline_runs'))
+            conn.execute(text('ALTER TABLE pipeline_runs_copy RENAME TO pipeline_runs'))
+            conn.execute(text('DROP TABLE latest_runs'))
+            conn.execute(text('CREATE TABLE latest_runs (project VARCHAR(255) NOT NULL, repository VARCHAR(255) '
+                              'NOT NULL, run_id INTEGER, result_id VARCHAR(255), PRIMARY KEY (project, repository))'))
+        engine.dispose()
+        db = PipelineResults(self.dburl)
+        inspector = inspect(create_engine(self.dburl))
+        columns = [column['name'] for column in inspector.get_columns('pipeline_runs')]
+        self.assertIn('branch', columns)
+        self.assertIn('source', columns)
+        self.assertEqual(['source', 'project', 'repository', 'branch'],
+                         inspector.get_pk_constraint('latest_runs')['constrained_columns'])
+        self.assertEqual({('TEST', 'test-repo', ''): 11}, db.get_high_water_marks())
+        self.assertEqual(3, db.adopt_legacy_runs(branch='develop'))
+        self.assertEqual({('TEST', 'test-repo', 'develop'): 11}, db.get_high_water_marks())
+        self.assertEqual(['test-repo/develop/11'], [run.id for run in db.get_open_runs()])
+
+    def test_latest_runs_with_oversized_keys_are_rebuilt(self):
+        """
+        Check a latest_runs table created with full length source and branch keys, too long for MySQL's key length
+        limit with utf8mb4, is recreated with the shorter keys and rebuilt from the history.
+        """
+        PipelineResults(self.dburl)
+        engine = create_engine(self.dburl)
+        with engine.begin() as conn:
+            conn.execute(text('DROP TABLE latest_runs'))
+            conn.execute(text('CREATE TABLE latest_runs (source VARCHAR(255) NOT NULL, project VARCHAR(255) NOT NULL, '
+                              'repository VARCHAR(255) NOT NULL, branch VARCHAR(255) NOT NULL, run_id INTEGER, '
+                              'result_id VARCHAR(255), PRIMARY KEY (source, project, repository, branch))'))
+        engine.dispose()
+        db = PipelineResults(self.dburl)
+        columns = dict((column['name'], column['type'])
+                       for column in inspect(create_engine(self.dburl)).get_columns('latest_runs'))
+        self.assertEqual(64, columns['source'].length)
+        self.assertEqual(191, columns['branch'].length)
+        self.assertEqual({('TEST', 'test-repo', ''): 11}, db.get_high_water_marks())
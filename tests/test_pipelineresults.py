@@ -1,11 +1,20 @@
+import os
+import shutil
+import tempfile
+import threading
 import time
 from unittest import TestCase
 
+from mock import patch
+from sqlalchemy import event, text
+from sqlalchemy.dialects import mysql
+
 from djinn import PipelineResults
+from djinn.database.entity import LatestRun, PipelineRun
 
 
 def generate_mock_result(project='TEST', repository=None, status='SUCCESS', success=True, run_id=1,
-                         timestamp=None):
+                         timestamp=None, branch=None, source=None):
     """
     Create a dict matching the format used for writing to the database.
     :param project: project name as string
@@ -13,23 +22,29 @@ def generate_mock_result(project='TEST', repository=None, status='SUCCESS', succ
     :param status: status as string
     :param success: boolean
     :param run_id: integer
-    :param timestamp: timestamp in milliseconds since epoch as string. If None, now will be used.
+    :param timestamp: timestamp in milliseconds since epoch as int. If None, now will be used.
+    :param branch: branch name. If None, the result is stored as if from before branches were recorded.
+    :param source: name of the Jenkins source. If None, the result is from the unnamed source.
     :return: result dictionary
     """
     if not timestamp:  # If no time provided, use right now.
-        timestamp = str(int(time.time() * 1000))
+        timestamp = int(time.time() * 1000)
     if not repository:
         repository = '{}-repo'.format(project.lower())
     result = dict(project=project, repository=repository, status=status, success=success, run_id=run_id,
                   timestamp=timestamp, id='{}{}'.format(repository, run_id))
+    if branch:
+        result.update(branch=branch, id='{}/{}/{}'.format(repository, branch, run_id))
+    if source:
+        result.update(source=source, id='{}/{}'.format(source, result['id']))
     return result
 
 
 class TestPipelineResults(TestCase):
-    successfulresult = {'status': u'SUCCESS', 'success': True, 'repository': 'jenkinsfile-test', 'run_id': u'7',
-                        'timestamp': '1491143071036', 'project': 'TEST', 'id': 'jenkinsfile-test7'}
+    successfulresult = {'status': u'SUCCESS', 'success': True, 'repository': 'jenkinsfile-test', 'run_id': 7,
+                        'timestamp': 1491143071036, 'project': 'TEST', 'id': 'jenkinsfile-test7'}
     failedresult = {'status': u'FAILED', 'error_type': u'hudson.AbortException', 'success': False,
-                    'repository': 'jenkinsfile-test', 'run_id': u'6', 'timestamp': '1491143013685',
+                    'repository': 'jenkinsfile-test', 'run_id': 6, 'timestamp': 1491143013685,
                     'error_message': u'Oops.', 'stage_failed': u'Setup', 'project': 'TEST', 'id': 'jenkinsfile-test6'}
 
     def setUp(self):
@@ -153,9 +168,9 @@ class TestPipelineResults(TestCase):
         self.assertEqual(len(latest), 2)
         for result in latest:
             if result.repository == 'test-repo':
-                self.assertEqual(result.run_id, '102')
+                self.assertEqual(result.run_id, 102)
             elif result.repository == 'newtest-repo':
-                self.assertEqual(result.run_id, '103')
+                self.assertEqual(result.run_id, 103)
 
     def test_get_latest_results_for_repo(self):
         """
@@ -168,4 +183,524 @@ class TestPipelineResults(TestCase):
         testlatest = self.db.get_latest_results_for_project('TEST')
         self.assertEqual(len(testlatest), 1)
         self.assertEqual(testlatest[0].repository, 'test-repo')
-        self.assertEqual(testlatest[0].run_id, '102')
+        self.assertEqual(testlatest[0].run_id, 102)
+
+    def test_high_water_marks_track_highest_run_id(self):
+        """
+        Check the highest run ID stored is tracked per repository, compared as integers rather than strings.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=x) for x in xrange(98, 101)])
+        self.db.insert_single_result(generate_mock_result(project='NEWTEST', run_id=5))
+        self.db.insert_single_result(generate_mock_result(run_id=9))
+        self.assertEqual({('TEST', 'test-repo', ''): 100, ('NEWTEST', 'newtest-repo', ''): 5},
+                         self.db.get_high_water_marks())
+
+    def test_branches_are_tracked_separately(self):
+        """
+        Check runs of different branches with the same run ID are all stored, and filtered and tracked by branch.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=x, branch=branch, timestamp=1000 * x)
+                                             for x in (1, 2, 3) for branch in ('develop', 'master')])
+        self.db.insert_single_result(generate_mock_result(run_id=4, branch='develop', timestamp=4000,
+                                                          status='IN_PROGRESS', success=False))
+        self.assertEqual(7, len(self.db.get_result_rows()))
+        self.assertEqual(['test-repo/master/1', 'test-repo/master/2', 'test-repo/master/3'],
+                         sorted(row.id for row in self.db.get_result_rows(branch='master')))
+        self.assertEqual({('TEST', 'test-repo', 'develop'): 4, ('TEST', 'test-repo', 'master'): 3},
+                         self.db.get_high_water_marks())
+        self.assertEqual(['test-repo/develop/4', 'test-repo/master/3'],
+                         sorted(row.id for row in self.db.get_latest_result_rows()))
+        self.assertEqual(['test-repo/master/3'], [row.id for row in self.db.get_latest_result_rows(branch='master')])
+        page, _ = self.db.get_result_rows_page(limit=2, branch='develop')
+        self.assertEqual(['test-repo/develop/4', 'test-repo/develop/3'], [row.id for row in page])
+        self.assertEqual(4, len(list(self.db.iter_result_rows(branch='develop'))))
+        self.assertEqual([('test-repo/develop/4', 'develop')],
+                         [(run.id, run.branch) for run in self.db.get_open_runs()])
+        self.db.rebuild_latest_runs()
+        self.assertEqual(['test-repo/develop/4', 'test-repo/master/3'],
+                         sorted(row.id for row in self.db.get_latest_result_rows()))
+
+    def test_sources_are_tracked_separately(self):
+        """
+        Check the same repository's runs from different Jenkins sources are all stored, and filtered and tracked by
+        source.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=x, branch='develop', source=source)
+                                             for x in (1, 2) for source in (None, 'emea')])
+        self.db.insert_single_result(generate_mock_result(run_id=3, branch='develop', source='emea',
+                                                          status='IN_PROGRESS', success=False))
+        self.assertEqual(5, len(self.db.get_result_rows()))
+        self.assertEqual(['emea/test-repo/develop/1', 'emea/test-repo/develop/2', 'emea/test-repo/develop/3'],
+                         sorted(row.id for row in self.db.get_result_rows(source='emea')))
+        self.assertEqual({('TEST', 'test-repo', 'develop'): 2}, self.db.get_high_water_marks())
+        self.assertEqual({('TEST', 'test-repo', 'develop'): 3}, self.db.get_high_water_marks(source='emea'))
+        self.assertEqual(['emea/test-repo/develop/3'],
+                         [row.id for row in self.db.get_latest_result_rows(source='emea')])
+        self.assertEqual([('emea/test-repo/develop/3', 'emea')],
+                         [(run.id, run.source) for run in self.db.get_open_runs()])
+        self.db.rebuild_latest_runs()
+        self.assertEqual(['emea/test-repo/develop/3', 'test-repo/develop/2'],
+                         sorted(row.id for row in self.db.get_latest_result_rows()))
+
+    def test_adopt_legacy_runs(self):
+        """
+        Check runs stored before branches were recorded are given the branch and ID they'd be crawled with now.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=1),
+                                             generate_mock_result(run_id=2, status='IN_PROGRESS', success=False)])
+        self.assertEqual(2, self.db.adopt_legacy_runs(branch='develop'))
+        self.assertEqual([('test-repo/develop/1', 'develop'), ('test-repo/develop/2', 'develop')],
+                         sorted((row.id, row.branch) for row in self.db.get_result_rows()))
+        self.assertEqual(['test-repo/develop/2'], [run.id for run in self.db.get_open_runs()])
+        self.assertEqual({('TEST', 'test-repo', 'develop'): 2}, self.db.get_high_water_marks())
+        # Crawling the adopted runs again doesn't store them twice, and adopting again does nothing.
+        counts = self.db.insert_single_result(generate_mock_result(run_id=1, branch='develop'))
+        self.assertEqual(1, counts['skipped'])
+        self.assertEqual(0, self.db.adopt_legacy_runs(branch='develop'))
+
+    def test_open_runs_track_in_progress_results(self):
+        """
+        Check runs stored as IN_PROGRESS are tracked as open until they're stored with a final status.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(status='IN_PROGRESS', success=False, run_id=1),
+                                             generate_mock_result(run_id=2)])
+        self.assertListEqual(['test-repo1'], [run.id for run in self.db.get_open_runs()])
+        self.db.insert_single_result(generate_mock_result(status='FAILED', success=False, run_id=1))
+        self.assertListEqual([], self.db.get_open_runs())
+        self.assertEqual('FAILED', self.db.get_result_by_primary_key('test-repo1').status)
+
+    def test_insert_batch_reports_inserted_updated_and_skipped(self):
+        """
+        Check a batch reports how many rows were inserted, updated from IN_PROGRESS and skipped as already stored.
+        """
+        counts = self.db.insert_result_batch(results=[generate_mock_result(status='IN_PROGRESS', run_id=1),
+                                                      generate_mock_result(run_id=2)])
+        self.assertEqual({'inserted': 2, 'updated': 0, 'skipped': 0}, counts)
+        batch = [generate_mock_result(run_id=x) for x in xrange(1, 1000)]
+        counts = self.db.insert_result_batch(results=batch)
+        self.assertEqual({'inserted': 997, 'updated': 1, 'skipped': 1}, counts)
+        self.assertEqual(999, len(self.db.get_results_for_project('TEST')))
+        self.assertEqual('SUCCESS', self.db.get_result_by_primary_key('test-repo1').status)
+
+    def test_insert_batch_with_duplicate_ids_keeps_last(self):
+        """
+        Check a batch containing the same run twice stores a single row using the last copy.
+        """
+        counts = self.db.insert_result_batch(results=[generate_mock_result(status='IN_PROGRESS', run_id=1),
+                                                      generate_mock_result(status='FAILED', success=False, run_id=1)])
+        self.assertEqual({'inserted': 1, 'updated': 0, 'skipped': 1}, counts)
+        self.assertEqual('FAILED', self.db.get_result_by_primary_key('test-repo1').status)
+
+    def test_run_ids_from_jenkins_are_stored_as_integers(self):
+        """
+        Check run IDs and timestamps given as strings, as Jenkins reports them, are stored as integers.
+        """
+        self.db.insert_single_result(generate_mock_result(run_id=u'10', timestamp='1491143071036'))
+        result = self.db.get_result_by_primary_key('test-repo10')
+        self.assertEqual(10, result.run_id)
+        self.assertEqual(1491143071036, result.timestamp)
+
+    def test_rebuild_latest_runs_from_history(self):
+        """
+        Check the latest run for each repository can be recalculated from the full history.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=x) for x in xrange(98, 101)] +
+                                    [generate_mock_result(project='NEWTEST', run_id=5)])
+        session = self.db.session_factory()
+        session.query(LatestRun).delete()
+        session.commit()
+        session.close()
+        self.assertListEqual([], self.db.get_latest_results())
+        self.db.rebuild_latest_runs()
+        latest = self.db.get_latest_results()
+        self.assertItemsEqual([('test-repo', 100), ('newtest-repo', 5)],
+                              [(run.repository, run.run_id) for run in latest])
+
+    def test_batch_updates_only_its_own_latest_runs(self):
+        """
+        Check a batch spanning more repository branches than fit in one lookup updates each one's latest run and
+        leaves repositories outside the batch untouched.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(repository='repo{}'.format(x), branch='master',
+                                                                  run_id=5) for x in xrange(300)])
+        self.db.insert_result_batch(results=[generate_mock_result(repository='repo{}'.format(x), branch='master',
+                                                                  run_id=run_id)
+                                             for x in xrange(0, 300, 2) for run_id in (4, 6)] +
+                                    [generate_mock_result(repository='repo0', branch='develop', run_id=1)])
+        latest = dict(((run.repository, run.branch), run.run_id) for run in self.db.get_latest_results())
+        self.assertEqual(301, len(latest))
+        self.assertEqual(6, latest[('repo0', 'master')])
+        self.assertEqual(5, latest[('repo1', 'master')])
+        self.assertEqual(6, latest[('repo298', 'master')])
+        self.assertEqual(1, latest[('repo0', 'develop')])
+
+    def test_get_failure_counts(self):
+        """
+        Check failures are counted per stage and project, or per stage and repository within a project.
+        """
+        batch = [generate_mock_result(run_id=x, status='FAILED', success=False) for x in xrange(3)]
+        batch += [generate_mock_result(project='NEWTEST', run_id=x, status='FAILED', success=False) for x in xrange(2)]
+        batch += [generate_mock_result(run_id=x) for x in xrange(3, 6)]
+        for result in batch[:2]:
+            result['stage_failed'] = 'Setup'
+        for result in batch[2:5]:
+            result['stage_failed'] = 'Deploy'
+        self.db.insert_result_batch(results=batch)
+        self.assertItemsEqual([('Setup', 'TEST', 2), ('Deploy', 'TEST', 1), ('Deploy', 'NEWTEST', 2)],
+                              self.db.get_failure_counts(group_by='project'))
+        self.assertItemsEqual([('Setup', 'test-repo', 2), ('Deploy', 'test-repo', 1)],
+                              self.db.get_failure_counts(group_by='repository', project='TEST'))
+
+    def test_failure_counts_follow_in_progress_updates(self):
+        """
+        Check the failure counts rollup moves a run's failure when it's updated from IN_PROGRESS, and matches a
+        rebuild from the full history.
+        """
+        running = generate_mock_result(status='IN_PROGRESS', success=False, run_id=1)
+        self.db.insert_result_batch(results=[running, generate_mock_result(run_id=2)])
+        self.assertListEqual([(None, 'TEST', 1)], self.db.get_failure_counts())
+        running.update({'status': 'FAILED', 'stage_failed': 'Deploy'})
+        self.db.insert_single_result(running)
+        self.assertListEqual([('Deploy', 'TEST', 1)], self.db.get_failure_counts())
+        running.update({'id': 'test-repo3', 'run_id': 3, 'status': 'SUCCESS', 'success': True})
+        self.db.insert_single_result(running)
+        self.assertListEqual([('Deploy', 'TEST', 1)], self.db.get_failure_counts())
+        self.db.rebuild_failure_counts()
+        self.assertListEqual([('Deploy', 'TEST', 1)], self.db.get_failure_counts())
+
+    def test_batch_locks_the_stored_rows_it_resolves(self):
+        """
+        Check stored rows are looked up with a locking read on server dialects, so concurrent writers resolving the
+        same IN_PROGRESS run can't both apply its failure count deltas.
+        """
+        self.db.insert_single_result(generate_mock_result(status='IN_PROGRESS', success=False, run_id=1))
+        statements = []
+
+        def record(conn, clause, *args):
+            statements.append(clause)
+
+        engine = self.db.write_session_factory.kw['bind']
+        event.listen(engine, 'before_execute', record)
+        try:
+            self.db.insert_single_result(generate_mock_result(status='FAILED', success=False, run_id=1))
+        finally:
+            event.remove(engine, 'before_execute', record)
+        lookups = [str(statement.compile(dialect=mysql.dialect())) for statement in statements
+                   if getattr(statement, 'is_select', False) and 'pipeline_runs' in str(statement)]
+        self.assertEqual(1, len(lookups))
+        self.assertTrue(lookups[0].endswith('FOR UPDATE'))
+        self.assertListEqual([(None, 'TEST', 1)], self.db.get_failure_counts())
+
+    def test_get_results_page_walks_history_newest_first(self):
+        """
+        Check paging through results visits every timestamped run once, newest first, breaking timestamp ties by ID.
+        """
+        results = [generate_mock_result(run_id=run_id, timestamp=1491143000000 + run_id // 2) for run_id in range(7)]
+        results.append(generate_mock_result(repository='untimed-repo', timestamp=None))
+        results[-1]['timestamp'] = None
+        self.db.insert_result_batch(results=results)
+        pages = list()
+        after = None
+        while True:
+            page, after = self.db.get_results_page(limit=3, after=after)
+            pages.append([run.id for run in page])
+            if after is None:
+                break
+        self.assertListEqual([['test-repo6', 'test-repo5', 'test-repo4'], ['test-repo3', 'test-repo2', 'test-repo1'],
+                              ['test-repo0']], pages)
+
+    def test_get_results_page_filters(self):
+        """
+        Check pages can be limited to a project, repository or point in time.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=1, timestamp=1000),
+                                             generate_mock_result(run_id=2, timestamp=2000),
+                                             generate_mock_result(project='OTHER', timestamp=3000)])
+        page, after = self.db.get_results_page(limit=10, project='TEST', timestamp=1500)
+        self.assertListEqual(['test-repo1'], [run.id for run in page])
+        self.assertIsNone(after)
+        page, after = self.db.get_results_page(limit=1, reponame='other-repo')
+        self.assertListEqual(['other-repo1'], [run.id for run in page])
+        self.assertIsNone(after)
+
+    def test_iter_results_streams_filtered_results(self):
+        """
+        Check results can be read lazily with the same filters as the list getters.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=1, timestamp=1000),
+                                             generate_mock_result(run_id=2, timestamp=2000),
+                                             generate_mock_result(project='OTHER', timestamp=3000)])
+        results = self.db.iter_results(project='TEST', batch_size=1)
+        self.assertEqual('test-repo1', next(results).id)
+        self.assertItemsEqual(['test-repo2'], [run.id for run in results])
+        self.assertItemsEqual(['test-repo1'], [run.id for run in self.db.iter_results(timestamp=1500)])
+        self.assertItemsEqual(['other-repo1'], [run.id for run in self.db.iter_results(reponame='other-repo')])
+
+    def test_getters_only_load_requested_fields(self):
+        """
+        Check restricting results to some columns leaves the others unread, apart from the primary key.
+        """
+        self.db.insert_result_batch(results=[self.successfulresult, self.failedresult])
+        fields = ['status', 'timestamp']
+        getters = [lambda: self.db.get_all_results(fields=fields),
+                   lambda: self.db.get_results_for_project('TEST', fields=fields),
+                   lambda: self.db.get_results_for_repo('jenkinsfile-test', fields=fields),
+                   lambda: self.db.get_latest_results(fields=fields),
+                   lambda: self.db.get_latest_results_for_project('TEST', fields=fields),
+                   lambda: self.db.get_results_page(limit=10, fields=fields)[0],
+                   lambda: list(self.db.iter_results(fields=fields))]
+        for getter in getters:
+            for result in getter():
+                self.assertItemsEqual(['id', 'status', 'timestamp'],
+                                      [key for key in result.__dict__ if not key.startswith('_')])
+
+    def test_row_getters_match_orm_getters(self):
+        """
+        Check the Core read methods return the same data as their ORM equivalents.
+        """
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=run_id, timestamp=1000 * run_id)
+                                             for run_id in range(1, 6)] + [self.failedresult, self.successfulresult])
+
+        def columns(results, fields=None):
+            fields = fields or [column.name for column in PipelineRun.__table__.columns]
+            return sorted(tuple(getattr(result, field) for field in fields) for result in results)
+
+        self.assertEqual(columns(self.db.get_all_results(timestamp=3000)),
+                         columns(self.db.get_result_rows(timestamp=3000)))
+        self.assertEqual(columns(self.db.get_results_for_project('TEST')),
+                         columns(self.db.get_result_rows(project='TEST')))
+        self.assertEqual(columns(self.db.get_results_for_repo('test-repo')),
+                         columns(self.db.get_result_rows(reponame='test-repo')))
+        self.assertEqual(columns(self.db.get_latest_results()), columns(self.db.get_latest_result_rows()))
+        self.assertEqual(columns(self.db.get_latest_results_for_project('TEST')),
+                         columns(self.db.get_latest_result_rows(project='TEST')))
+        self.assertEqual(columns(self.db.iter_results(project='TEST')),
+                         columns(self.db.iter_result_rows(project='TEST', batch_size=2)))
+        orm_page, orm_after = self.db.get_results_page(limit=3, after=(4000, 'test-repo4'))
+        core_page, core_after = self.db.get_result_rows_page(limit=3, after=(4000, 'test-repo4'))
+        self.assertEqual([run.id for run in orm_page], [row.id for row in core_page])
+        self.assertEqual(orm_after, core_after)
+
+    def test_row_getters_only_select_requested_fields(self):
+        self.db.insert_result_batch(results=[self.successfulresult])
+        row = self.db.get_result_rows(fields=['status'])[0]
+        self.assertEqual({'id': 'jenkinsfile-test7', 'status': 'SUCCESS'}, row._asdict())
+
+    def test_pool_options_are_passed_to_engine(self):
+        """
+        Check pool sizing is applied to server databases and left out for SQLite, whose pools don't take it.
+        """
+        with patch('djinn.database.pipelineresults.create_engine', side_effect=RuntimeError) as create_engine:
+            self.assertRaises(RuntimeError, PipelineResults, 'mysql+mysqldb://djinn@localhost/djinn', pool_size=4,
+                              max_overflow=2, pool_recycle=240, pool_pre_ping=True)
+        create_engine.assert_called_once_with('mysql+mysqldb://djinn@localhost/djinn', echo=False, pool_size=4,
+                                              max_overflow=2, pool_recycle=240, pool_pre_ping=True)
+        db = PipelineResults('sqlite://', pool_size=4, max_overflow=2, pool_recycle=240, pool_pre_ping=True)
+        self.assertEqual([], db.get_projects())
+
+    def test_reads_share_a_request_session(self):
+        """
+        Check reads made between begin_request and end_request reuse one session.
+        """
+        self.db.insert_single_result(self.successfulresult)
+        self.db.begin_request()
+        with self.db._read_session() as first, self.db._read_session() as second:
+            self.assertIs(first, second)
+        self.assertTrue(self.db.check_project_exists('TEST'))
+        self.assertEqual(['TEST'], self.db.get_projects())
+        self.db.end_request()
+        with self.db._read_session() as session:
+            self.assertIsNot(first, session)
+
+
+class TestPipelineResultsSQLiteConcurrency(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dburl = 'sqlite:///{}'.format(os.path.join(self.tempdir, 'concurrency.db'))
+        self.db = PipelineResults(self.dburl)
+        self.db.insert_result_batch(results=[generate_mock_result(run_id=run_id, timestamp=1000 * run_id)
+                                             for run_id in range(1, 11)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def timed_read(self, read):
+        start = time.time()
+        result = read()
+        self.assertLess(time.time() - start, 1)
+        return result
+
+    def test_data_version_is_shared_between_instances(self):
+        """
+        Check a write by one instance is seen in another's data version and last modified time, so neither serves
+        responses cached before it.
+        """
+        other = PipelineResults(self.dburl)
+        version, modified = other.get_data_version()
+        self.assertEqual((version, modified), self.db.get_data_version())
+        self.db.insert_single_result(generate_mock_result(run_id=11))
+        self.assertEqual(version + 1, other.data_version)
+        self.assertLessEqual(modified, other.get_data_version()[1])
+        self.assertEqual(self.db.get_data_version(), other.get_data_version())
+
+    def test_database_file_uses_wal(self):
+        with self.db._read_session() as session:
+            self.assertEqual('wal', session.execute(text('PRAGMA journal_mode')).scalar())
+            self.assertEqual(1, session.execute(text('PRAGMA synchronous')).scalar())
+
+    def test_reads_are_not_blocked_by_ingest_in_progress(self):
+        """
+        Check reads return promptly with the last committed data while a batch is partway through being written.
+        """
+        writing, release = threading.Event(), threading.Event()
+
+        def block(session, rows):
+            writing.set()
+            release.wait(10)
+            return PipelineResults._update_latest_runs(session, rows)
+
+        batch = [generate_mock_result(project='NEW', run_id=run_id) for run_id in range(1, 101)]
+        with patch.object(self.db, '_update_latest_runs', side_effect=block):
+            ingest = threading.Thread(target=self.db.insert_result_batch, args=(batch,))
+            ingest.start()
+            try:
+                self.assertTrue(writing.wait(10))
+                self.assertEqual(10, len(self.timed_read(self.db.get_result_rows)))
+                self.assertEqual(['TEST'], self.timed_read(self.db.get_projects))
+                self.assertFalse(self.timed_read(lambda: self.db.check_project_exists('NEW')))
+                self.assertEqual(1, len(self.timed_read(self.db.get_latest_results)))
+            finally:
+                release.set()
+                ingest.join(10)
+        self.assertFalse(ingest.is_alive())
+        self.assertEqual(110, len(self.db.get_result_rows()))
+
+    def test_ingest_commits_while_a_read_is_in_progress(self):
+        """
+        Check a batch can be committed while a reader is partway through a result set, and the reader carries on
+        with the snapshot it started with.
+        """
+        results = self.db.iter_result_rows(batch_size=1)
+        first = next(results)
+        ingest = threading.Thread(target=self.db.insert_result_batch,
+                                  args=([generate_mock_result(project='NEW', run_id=1)],))
+        ingest.start()
+        ingest.join(10)
+        self.assertFalse(ingest.is_alive())
+        self.assertEqual(10, len([first] + list(results)))
+        self.assertEqual(11, len(self.db.get_result_rows()))
+
+    def test_concurrent_writers_are_serialized(self):
+        """
+        Check batches written from several threads at once are all stored, without lock errors.
+        """
+        errors = list()
+
+        def ingest(project):
+            try:
+                for run_id in range(1, 6):
+                    self.db.insert_single_result(generate_mock_result(project=project, run_id=run_id))
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=ingest, args=('PROJ{}'.format(i),)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        self.assertEqual([], errors)
+        self.assertEqual(30, len(self.db.get_result_rows()))
+
+
+class TestPipelineResultsReadReplica(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        primary = 'sqlite:///{}'.format(os.path.join(self.tempdir, 'primary.db'))
+        replica = 'sqlite:///{}'.format(os.path.join(self.tempdir, 'replica.db'))
+        # Give the replica its own schema and contents, so we can tell which database a read went to.
+        PipelineResults(replica).insert_single_result(generate_mock_result(project='REPLICA'))
+        # Create the primary's schema first, since populating new tables counts as a write.
+        PipelineResults(primary)
+        self.db = PipelineResults(primary, read_connection_url=replica, read_your_writes_window=60)
+        self.replica = PipelineResults(replica)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_reads_are_routed_to_replica(self):
+        self.assertEqual(['REPLICA'], self.db.get_projects())
+        self.assertEqual(['replica-repo1'], [row.id for row in self.db.get_result_rows()])
+        self.db.begin_request()
+        self.assertTrue(self.db.check_project_exists('REPLICA'))
+        self.db.end_request()
+
+    def test_writes_go_to_primary(self):
+        self.db.insert_single_result(generate_mock_result(project='PRIMARY'))
+        self.assertEqual(['REPLICA'], self.replica.get_projects())
+        with self.db.write_session_factory() as session:
+            self.assertEqual(['PRIMARY'], [row.project for row in session.query(PipelineRun).all()])
+
+    def test_reads_go_to_primary_after_a_write(self):
+        self.db.insert_single_result(generate_mock_result(project='PRIMARY'))
+        self.assertEqual(['PRIMARY'], self.db.get_projects())
+        self.assertEqual(['primary-repo1'], [row.id for row in self.db.iter_result_rows()])
+        with patch('djinn.database.pipelineresults.time.time', return_value=self.db.last_write + 61):
+            self.assertEqual(['REPLICA'], self.db.get_projects())
+
+
+class TestPipelineResultsCrawlLeases(TestCase):
+    folders = ['PROJ1', 'PROJ2', 'PROJ3', 'PROJ4']
+
+    def setUp(self):
+        self.db = PipelineResults('sqlite:///')
+
+    def test_leases_are_exclusive(self):
+        self.assertEqual(self.folders, self.db.acquire_leases('a', self.folders, ttl=60, now=1000))
+        self.assertEqual([], self.db.acquire_leases('b', self.folders, ttl=60, now=1001))
+        leases = self.db.get_leases()
+        self.assertEqual(set(self.folders), set(leases))
+        self.assertEqual({('a', 1060000)}, set(leases.values()))
+
+    def test_leases_are_renewed(self):
+        self.db.acquire_leases('a', self.folders, ttl=60, now=1000)
+        self.assertEqual(self.folders, self.db.acquire_leases('a', self.folders, ttl=60, now=1050))
+        self.assertEqual([], self.db.acquire_leases('b', self.folders, ttl=60, now=1100))
+        self.assertEqual({('a', 1110000)}, set(self.db.get_leases().values()))
+
+    def test_expired_leases_are_taken_over(self):
+        self.db.acquire_leases('a', self.folders[:2], ttl=60, now=1000)
+        self.assertEqual(self.folders[2:], self.db.acquire_leases('b', self.folders, ttl=60, now=1059))
+        self.assertEqual(self.folders, sorted(self.db.acquire_leases('b', self.folders, ttl=60, now=1060)))
+        self.assertEqual([], self.db.acquire_leases('a', self.folders, ttl=60, now=1061))
+
+    def test_leases_beyond_limit_are_released(self):
+        self.assertEqual(self.folders, self.db.acquire_leases('a', self.folders, ttl=60, now=1000))
+        self.assertEqual(self.folders[:2], self.db.acquire_leases('a', self.folders, ttl=60, limit=2, now=1010))
+        self.assertEqual(self.folders[2:], self.db.acquire_leases('b', self.folders, ttl=60, limit=2, now=1020))
+
+    def test_leases_on_removed_folders_are_released(self):
+        self.db.acquire_leases('a', self.folders, ttl=60, now=1000)
+        self.assertEqual(self.folders[1:], self.db.acquire_leases('a', self.folders[1:], ttl=60, now=1010))
+        self.assertEqual(set(self.folders[1:]), set(self.db.get_leases()))
+
+    def test_release_leases(self):
+        self.db.register_crawler('a', ttl=60, now=1000)
+        self.db.acquire_leases('a', self.folders, ttl=60, now=1000)
+        self.db.release_leases('a')
+        self.assertEqual(dict(), self.db.get_leases())
+        self.assertEqual(1, self.db.register_crawler('b', ttl=60, now=1001))
+        self.assertEqual(self.folders, self.db.acquire_leases('b', self.folders, ttl=60, now=1001))
+
+    def test_register_crawler_counts_running_instances(self):
+        self.assertEqual(1, self.db.register_crawler('a', ttl=60, now=1000))
+        self.assertEqual(2, self.db.register_crawler('b', ttl=60, now=1010))
+        self.assertEqual(2, self.db.register_crawler('a', ttl=60, now=1050))
+        # b hasn't renewed within its ttl, so it's presumed dead.
+        self.assertEqual(1, self.db.register_crawler('a', ttl=60, now=1070))
+
+    def test_leases_do_not_change_data_version(self):
+        version = self.db.data_version
+        self.db.register_crawler('a', ttl=60)
+        self.db.acquire_leases('a', self.folders, ttl=60)
+        self.db.release_leases('a')
+        self.assertEqual(version, self.db.data_version)
@@ -0,0 +1,108 @@
+import threading
+from unittest import TestCase
+
+from djinn.djenkins.resilience import CircuitBreaker, TokenBucket
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.bucket = TokenBucket(rate=2, burst=4, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, TokenBucket, rate=0)
+
+    def test_burst_goes_through_immediately(self):
+        self.assertEqual([0, 0, 0, 0], [self.bucket.acquire() for _ in range(4)])
+        self.assertEqual(1000.0, self.clock.now)
+
+    def test_requests_beyond_burst_are_paced_at_rate(self):
+        for _ in range(4):
+            self.bucket.acquire()
+        self.assertEqual([0.5, 0.5, 0.5], [self.bucket.acquire() for _ in range(3)])
+        self.assertEqual(1001.5, self.clock.now)
+
+    def test_tokens_refill_up_to_burst(self):
+        for _ in range(4):
+            self.bucket.acquire()
+        self.clock.now += 60
+        self.assertEqual([0, 0, 0, 0, 0.5], [self.bucket.acquire() for _ in range(5)])
+
+    def test_default_burst_is_one_second(self):
+        self.assertEqual(2, TokenBucket(rate=2).capacity)
+        self.assertEqual(1, TokenBucket(rate=0.1).capacity)
+
+    def test_waiting_threads_queue_up(self):
+        bucket = TokenBucket(rate=1, burst=1, clock=lambda: 1000.0, sleep=lambda seconds: None)
+        waits = list()
+        threads = [threading.Thread(target=lambda: waits.append(bucket.acquire())) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([0, 1, 2, 3, 4], sorted(waits))
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60, clock=self.clock)
+
+    def fail(self, times):
+        for _ in range(times):
+            self.breaker.record_failure()
+
+    def test_invalid_threshold(self):
+        self.assertRaises(ValueError, CircuitBreaker, failure_threshold=0)
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.assertTrue(self.breaker.allow())
+        self.fail(1)
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(1, self.breaker.trips)
+
+    def test_success_resets_failures(self):
+        self.fail(2)
+        self.breaker.record_success()
+        self.fail(2)
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+    def test_single_trial_after_reset_timeout(self):
+        self.fail(3)
+        self.clock.now += 59
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(CircuitBreaker.HALF_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_trial_closes(self):
+        self.fail(3)
+        self.clock.now += 60
+        self.breaker.allow()
+        self.breaker.record_success()
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        self.fail(3)
+        self.clock.now += 60
+        self.breaker.allow()
+        self.fail(1)
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.assertEqual(2, self.breaker.trips)
+        self.clock.now += 59
+        self.assertFalse(self.breaker.allow())
@@ -0,0 +1,426 @@
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from falcon import testing
+from mock import MagicMock, patch
+
+from djinn import DJenkins, PollScheduler, PipelineResults
+from djinn.api import DJinnAPI
+from djinn.djenkins import JenkinsUnavailable
+
+
+class FakeClock(object):
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestPollScheduler(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.djinn = MagicMock()
+        self.djinn.dj.discover_jobs.return_value = {'PROJ': {'repo1': {'develop': 1},
+                                                             'repo2': {'develop': 1, 'master': 1},
+                                                             'repo3': {'master': 1}}}
+        self.djinn.dj.get_pipeline_history_for_repo.return_value = list()
+        self.djinn.db.get_high_water_marks.return_value = dict()
+        self.djinn.sources = {None: self.djinn.dj}
+        self.scheduler = PollScheduler(djinn=self.djinn, min_interval=60, max_interval=3600, clock=self.clock,
+                                       rand=random.Random(1))
+
+    def tearDown(self):
+        if self.scheduler.pool is not None:
+            self.scheduler.pool.terminate()
+
+    def timestamps(self, gap, count, since_last=0):
+        last = (self.clock.now - since_last) * 1000
+        return [last - i * gap * 1000 for i in range(count)]
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, PollScheduler, djinn=self.djinn, workers=0)
+        self.assertRaises(ValueError, PollScheduler, djinn=self.djinn, min_interval=600, max_interval=60)
+
+    def test_interval_for_busy_repo(self):
+        self.assertEqual(self.scheduler.interval_for(self.timestamps(gap=600, count=10)), 300)
+        self.assertEqual(self.scheduler.interval_for(self.timestamps(gap=10, count=10)), 60)
+
+    def test_interval_for_dormant_repo(self):
+        self.assertEqual(self.scheduler.interval_for(self.timestamps(gap=600, count=10, since_last=2000)), 1000)
+        self.assertEqual(self.scheduler.interval_for(self.timestamps(gap=600, count=10, since_last=86400)), 3600)
+
+    def test_interval_for_short_history(self):
+        self.assertEqual(self.scheduler.interval_for(list()), 3600)
+        self.assertEqual(self.scheduler.interval_for(self.timestamps(gap=600, count=1)), 3600)
+        self.assertEqual(self.scheduler.interval_for([None, None]), 3600)
+
+    def test_jitter_bounds(self):
+        for _ in range(1000):
+            interval = self.scheduler._jittered(1000)
+            self.assertTrue(900 <= interval <= 1100)
+
+    def test_discover_spreads_first_polls(self):
+        self.scheduler.discover()
+        self.assertEqual(set(self.scheduler.due), {(None, 'PROJ', 'repo1', 'develop'),
+                                                   (None, 'PROJ', 'repo2', 'develop')})
+        for due in self.scheduler.due.values():
+            self.assertTrue(self.clock.now <= due <= self.clock.now + 60)
+        self.assertEqual(self.scheduler.next_discovery, self.clock.now + 3600)
+
+    def test_discover_schedules_each_matching_branch(self):
+        self.scheduler.pipelinebranch = ['develop', 'mast*']
+        self.scheduler.discover()
+        self.assertEqual(set(self.scheduler.due), {(None, 'PROJ', 'repo1', 'develop'),
+                                                   (None, 'PROJ', 'repo2', 'develop'),
+                                                   (None, 'PROJ', 'repo2', 'master'),
+                                                   (None, 'PROJ', 'repo3', 'master')})
+
+    def test_discover_removes_vanished_repos(self):
+        self.scheduler.discover()
+        self.djinn.dj.discover_jobs.return_value = {'PROJ': {'repo1': {'develop': 1}}}
+        self.scheduler.discover()
+        self.assertEqual(set(self.scheduler.due), {(None, 'PROJ', 'repo1', 'develop')})
+        self.clock.now += 60
+        self.assertEqual(self.scheduler._pop_due(self.clock.now), [(None, 'PROJ', 'repo1', 'develop')])
+
+    def test_discover_keeps_existing_schedule(self):
+        self.scheduler.discover()
+        due = dict(self.scheduler.due)
+        self.scheduler.discover()
+        self.assertEqual(self.scheduler.due, due)
+
+    def test_poll_saves_history_and_reschedules(self):
+        history = [{'id': 'repo1{}'.format(i), 'timestamp': t} for i, t in enumerate(self.timestamps(600, 10))]
+        self.djinn.dj.get_pipeline_history_for_repo.return_value = history
+        self.scheduler.discover()
+        key = (None, 'PROJ', 'repo1', 'develop')
+        self.scheduler.in_flight.add(key)
+        self.scheduler.due[key] = None
+        self.scheduler.poll(key)
+        self.djinn.dj.get_pipeline_history_for_repo.assert_called_with(projectname='PROJ', reponame='repo1',
+                                                                      pipelinebranch='develop')
+        self.djinn.db.insert_result_batch.assert_called_with(history)
+        self.assertEqual(self.scheduler.intervals[key], 300)
+        self.assertTrue(self.clock.now + 270 <= self.scheduler.due[key] <= self.clock.now + 330)
+        self.assertNotIn(key, self.scheduler.in_flight)
+        self.assertEqual(self.scheduler.polls, 1)
+
+    def test_poll_skips_branches_unchanged_since_discovery(self):
+        """
+        Check the first poll after a discovery skips fetching a branch whose last build is the latest run stored, or
+        which has never built, while later polls and branches that have built since are fetched.
+        """
+        self.djinn.dj.discover_jobs.return_value = {'PROJ': {'repo1': {'develop': 7}, 'repo2': {'develop': 8},
+                                                             'repo3': {'develop': None}}}
+        self.djinn.db.get_high_water_marks.return_value = {('PROJ', 'repo1', 'develop'): 7,
+                                                           ('PROJ', 'repo2', 'develop'): 7}
+        self.scheduler.discover()
+        self.djinn.db.get_high_water_marks.assert_called_with(source=None)
+        fetch = self.djinn.dj.get_pipeline_history_for_repo
+        for repo in ('repo1', 'repo3'):
+            key = (None, 'PROJ', repo, 'develop')
+            self.scheduler.due[key] = None
+            self.scheduler.poll(key)
+            self.assertEqual(0, fetch.call_count)
+            self.assertTrue(self.scheduler.due[key] <= self.clock.now + 60 * 1.1)
+        self.scheduler.poll((None, 'PROJ', 'repo1', 'develop'))
+        fetch.assert_called_once_with(projectname='PROJ', reponame='repo1', pipelinebranch='develop')
+        self.scheduler.poll((None, 'PROJ', 'repo2', 'develop'))
+        fetch.assert_called_with(projectname='PROJ', reponame='repo2', pipelinebranch='develop')
+        self.assertEqual(2, self.scheduler.stats()['skipped'])
+        self.assertEqual(4, self.scheduler.stats()['polls'])
+        self.scheduler.discover()
+        self.scheduler.intervals[(None, 'PROJ', 'repo1', 'develop')] = 1000
+        self.scheduler.poll((None, 'PROJ', 'repo1', 'develop'))
+        self.assertEqual(2, fetch.call_count)
+        self.assertTrue(self.clock.now + 900 <= self.scheduler.due[(None, 'PROJ', 'repo1', 'develop')] <=
+                        self.clock.now + 1100)
+
+    def test_poll_failure_is_counted_and_rescheduled(self):
+        self.djinn.dj.get_pipeline_history_for_repo.side_effect = Exception('Jenkins is down')
+        self.scheduler.discover()
+        key = (None, 'PROJ', 'repo1', 'develop')
+        self.scheduler.due[key] = None
+        self.scheduler.poll(key)
+        self.assertEqual(self.scheduler.failures, 1)
+        self.assertEqual(self.scheduler.polls, 1)
+        self.assertTrue(self.scheduler.due[key] <= self.clock.now + 3600 * 1.1)
+
+    def test_poll_is_retried_soon_while_jenkins_is_unavailable(self):
+        self.djinn.dj.get_pipeline_history_for_repo.side_effect = JenkinsUnavailable('Jenkins appears to be down')
+        self.scheduler.discover()
+        key = (None, 'PROJ', 'repo1', 'develop')
+        self.scheduler.intervals[key] = 3000
+        self.scheduler.due[key] = None
+        self.scheduler.poll(key)
+        self.assertEqual(self.scheduler.failures, 1)
+        self.assertEqual(self.scheduler.intervals[key], 3000)
+        self.assertTrue(self.scheduler.due[key] <= self.clock.now + 60 * 1.1)
+
+    def test_poll_of_removed_repo_is_not_rescheduled(self):
+        self.scheduler.discover()
+        key = (None, 'PROJ', 'repo1', 'develop')
+        self.scheduler.in_flight.add(key)
+        self.scheduler.due[key] = None
+        self.djinn.dj.discover_jobs.return_value = {'PROJ': {'repo2': {'develop': 1}}}
+        self.scheduler.discover()
+        self.scheduler.poll(key)
+        self.assertNotIn(key, self.scheduler.due)
+
+    def test_stats_report_queue_depth_and_lag(self):
+        self.scheduler.discover()
+        self.assertEqual(self.scheduler.stats()['queue_depth'], 0)
+        self.clock.now += 120
+        first_due = min(self.scheduler.due.values())
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['scheduled'], 2)
+        self.assertEqual(stats['queue_depth'], 2)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(stats['lag'], self.clock.now - first_due)
+        self.assertIsNone(stats['mean_interval'])
+
+    def test_stats_count_repos_waiting_for_a_worker(self):
+        """
+        Check repositories overdue while every worker is busy stay queued, and are reported as queue depth and lag.
+        """
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch(**kwargs):
+            started.set()
+            release.wait(10)
+            return list()
+
+        self.djinn.dj.get_pipeline_history_for_repo.side_effect = fetch
+        self.djinn.dj.discover_jobs.return_value = {'PROJ': dict(('repo{}'.format(i), {'develop': 1})
+                                                                 for i in range(50))}
+        self.scheduler.discover()
+        self.clock.now += 560
+        self.assertEqual(self.scheduler.run_pending(), 1)
+        self.assertTrue(started.wait(10))
+        self.assertEqual(self.scheduler.run_pending(), 0)
+        stats = self.scheduler.stats()
+        release.set()
+        self.assertEqual(stats['in_flight'], 1)
+        self.assertEqual(stats['queue_depth'], 49)
+        self.assertTrue(500 <= stats['lag'] <= 560)
+
+    def test_each_source_is_discovered_and_polled(self):
+        """
+        Check repositories on every Jenkins source are scheduled under their source, polled from it, and kept when
+        their source can't be reached for a rediscovery.
+        """
+        emea = MagicMock(spec=DJenkins)
+        emea.discover_jobs.return_value = {'PROJ': {'repo1': {'develop': 1}}}
+        emea.get_pipeline_history_for_repo.return_value = list()
+        emea.stats.return_value = {'requests': 1}
+        self.djinn.sources = {None: self.djinn.dj, 'emea': emea}
+        self.scheduler.discover()
+        self.assertEqual(set(self.scheduler.due), {(None, 'PROJ', 'repo1', 'develop'),
+                                                   (None, 'PROJ', 'repo2', 'develop'),
+                                                   ('emea', 'PROJ', 'repo1', 'develop')})
+        key = ('emea', 'PROJ', 'repo1', 'develop')
+        self.scheduler.due[key] = None
+        self.scheduler.poll(key)
+        emea.get_pipeline_history_for_repo.assert_called_with(projectname='PROJ', reponame='repo1',
+                                                              pipelinebranch='develop')
+        self.assertEqual(0, self.djinn.dj.get_pipeline_history_for_repo.call_count)
+        emea.discover_jobs.side_effect = JenkinsUnavailable('Jenkins appears to be down')
+        self.djinn.dj.discover_jobs.return_value = {'PROJ': {'repo1': {'develop': 1}}}
+        self.scheduler.discover()
+        self.assertEqual(set(self.scheduler.due), {(None, 'PROJ', 'repo1', 'develop'), key})
+        self.assertEqual({'emea': {'requests': 1}}, self.scheduler.stats()['sources'])
+
+    def test_repo_is_not_polled_while_in_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch(**kwargs):
+            started.set()
+            release.wait(10)
+            return list()
+
+        self.djinn.dj.get_pipeline_history_for_repo.side_effect = fetch
+        self.djinn.dj.discover_jobs.return_value = {'PROJ': {'repo1': {'develop': 1}}}
+        self.scheduler.workers = 2
+        self.scheduler.discover()
+        self.clock.now += 60
+        self.assertEqual(self.scheduler.run_pending(), 1)
+        self.assertTrue(started.wait(10))
+        # Due again, and rediscovered, while the first poll is still running.
+        self.clock.now += 3600 * 2
+        self.assertEqual(self.scheduler.run_pending(), 0)
+        self.assertEqual(self.scheduler.stats()['in_flight'], 1)
+        release.set()
+        deadline = time.time() + 10
+        while self.scheduler.stats()['polls'] < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.djinn.dj.get_pipeline_history_for_repo.call_count, 1)
+        self.assertEqual(self.scheduler.stats()['in_flight'], 0)
+        self.assertEqual(len(self.scheduler.due), 1)
+
+
+def discovery_for(folders):
+    """
+    Build a discovery of one repository with a develop branch in each folder.
+    :param folders: list of folder names
+    :return: dict as returned by DJenkins.discover_jobs
+    """
+    return dict((folder, {'repo': {'develop': 1}}) for folder in folders)
+
+
+def leasing_scheduler(dburl, folders, owner, lease_duration=60):
+    """
+    Create a scheduler polling a mock Jenkins, sharing a real database with other instances.
+    """
+    djinn = MagicMock()
+    djinn.db = PipelineResults(dburl)
+    djinn.dj.discover_jobs.return_value = discovery_for(folders)
+    djinn.sources = {None: djinn.dj}
+    return PollScheduler(djinn=djinn, lease_duration=lease_duration, owner=owner)
+
+
+def claim_repeatedly(dburl, folders, owner, rounds, results):
+    """
+    Run in a separate process: rediscover and claim leases a number of times, then report the repositories scheduled.
+    """
+    scheduler = leasing_scheduler(dburl, folders, owner)
+    for _ in range(rounds):
+        scheduler.discover()
+        time.sleep(0.05)
+    results.put((owner, sorted(scheduler.due)))
+
+
+def claim_and_die(dburl, folders, owner):
+    """
+    Run in a separate process: claim leases, then exit without releasing them.
+    """
+    leasing_scheduler(dburl, folders, owner, lease_duration=1).discover()
+    os._exit(0)
+
+
+class TestPollSchedulerLeases(TestCase):
+    folders = ['PROJ{}'.format(i) for i in range(7)]
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dburl = 'sqlite:///{}'.format(os.path.join(self.tempdir, 'leases.db'))
+        # Create the schema once, rather than racing to create it from every process.
+        PipelineResults(self.dburl)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_single_instance_polls_everything(self):
+        scheduler = leasing_scheduler(self.dburl, self.folders, 'a')
+        scheduler.discover()
+        self.assertEqual(set(self.folders), scheduler.leased)
+        self.assertEqual(set((None, folder, 'repo', 'develop') for folder in self.folders), set(scheduler.due))
+        self.assertEqual(self.folders, scheduler.stats()['leased'])
+
+    def test_instances_split_folders(self):
+        first = leasing_scheduler(self.dburl, self.folders, 'a')
+        second = leasing_scheduler(self.dburl, self.folders, 'b')
+        first.discover()
+        second.discover()
+        self.assertEqual(set(), second.leased)
+        # The first instance gives up its excess once it sees the second, which then takes it.
+        first.claim()
+        second.claim()
+        self.assertEqual(4, len(first.leased))
+        self.assertEqual(3, len(second.leased))
+        self.assertEqual(set(self.folders), first.leased | second.leased)
+        self.assertFalse(set(first.due) & set(second.due))
+
+    def test_folders_are_dropped_when_leases_expire_unrenewed(self):
+        """
+        Check an instance which can't renew its leases stops polling their folders once they expire, rather than
+        racing whichever instance takes them over.
+        """
+        scheduler = leasing_scheduler(self.dburl, self.folders, 'a')
+        scheduler.clock = FakeClock(time.time())
+        scheduler.djinn.dj.get_pipeline_history_for_repo.return_value = list()
+        self.addCleanup(lambda: scheduler.pool and scheduler.pool.terminate())
+        scheduler.discover()
+        with patch.object(scheduler.djinn.db, 'register_crawler', side_effect=Exception('database is down')):
+            scheduler.clock.now += 30
+            scheduler.run_pending()
+            self.assertEqual(set(self.folders), scheduler.leased)
+            scheduler.clock.now += 30
+            scheduler.run_pending()
+        self.assertEqual(set(), scheduler.leased)
+        self.assertEqual(dict(), scheduler.due)
+        # Leasing resumes once renewal succeeds again.
+        scheduler.clock.now += 30
+        scheduler.run_pending()
+        self.assertEqual(set(self.folders), scheduler.leased)
+
+    def test_released_folders_are_taken_over(self):
+        first = leasing_scheduler(self.dburl, self.folders, 'a')
+        second = leasing_scheduler(self.dburl, self.folders, 'b')
+        first.discover()
+        second.discover()
+        first.release()
+        self.assertEqual(dict(), first.due)
+        second.claim()
+        self.assertEqual(set(self.folders), second.leased)
+
+    def test_folders_are_leased_per_source(self):
+        """
+        Check folders with the same name on different Jenkins sources are leased separately.
+        """
+        scheduler = leasing_scheduler(self.dburl, ['PROJ'], 'a')
+        emea = MagicMock(spec=DJenkins)
+        emea.discover_jobs.return_value = discovery_for(['PROJ'])
+        scheduler.djinn.sources['emea'] = emea
+        scheduler.discover()
+        self.assertEqual({'PROJ', 'emea/PROJ'}, scheduler.leased)
+        self.assertEqual({(None, 'PROJ', 'repo', 'develop'), ('emea', 'PROJ', 'repo', 'develop')}, set(scheduler.due))
+
+    def test_processes_share_one_crawl(self):
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=claim_repeatedly, args=(self.dburl, self.folders, owner, 40,
+                                                                            results))
+                     for owner in ('a', 'b', 'c')]
+        for process in processes:
+            process.start()
+        scheduled = dict(results.get(timeout=60) for _ in processes)
+        for process in processes:
+            process.join(10)
+        polled = [key for keys in scheduled.values() for key in keys]
+        # Every repository is polled by exactly one instance, and no instance takes more than its share.
+        self.assertEqual(sorted((None, folder, 'repo', 'develop') for folder in self.folders), sorted(polled))
+        for keys in scheduled.values():
+            self.assertLessEqual(len(keys), 3)
+
+    def test_dead_process_is_taken_over(self):
+        process = multiprocessing.Process(target=claim_and_die, args=(self.dburl, self.folders, 'dead'))
+        process.start()
+        process.join(30)
+        scheduler = leasing_scheduler(self.dburl, self.folders, 'survivor')
+        scheduler.discover()
+        self.assertEqual(set(), scheduler.leased)
+        time.sleep(1.1)
+        scheduler.claim()
+        self.assertEqual(set(self.folders), scheduler.leased)
+
+
+class TestSchedulerResource(testing.TestCase):
+    def test_scheduler_stats_are_served(self):
+        scheduler = MagicMock()
+        scheduler.stats.return_value = {'queue_depth': 3, 'lag': 12.5}
+        self.api = DJinnAPI(djenkins=MagicMock(), pipeline_results=MagicMock(), scheduler=scheduler)
+        response = self.simulate_get('/scheduler/')
+        self.assertEqual(json.loads(response.text), {'queue_depth': 3, 'lag': 12.5})
+
+    def test_scheduler_route_requires_scheduler(self):
+        self.api = DJinnAPI(djenkins=MagicMock(), pipeline_results=MagicMock())
+        self.assertEqual(self.simulate_get('/scheduler/').status_code, 404)